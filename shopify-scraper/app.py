@@ -1,604 +1,3667 @@
-# app.py - Fixed Universal E-commerce Product Scraper with Better Encoding
-import os
-from flask import Flask, request, jsonify, render_template, send_file
-from flask_sqlalchemy import SQLAlchemy
-from flask_cors import CORS
-import requests
-from bs4 import BeautifulSoup
-import time
-import re
-import csv
-import io
-import uuid
-from datetime import datetime
-from urllib.parse import urljoin, urlparse
-import threading
-import logging
-import random
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Initialize Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///products.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Initialize extensions
-db = SQLAlchemy(app)
-CORS(app)
-
-# Database Models
-class ScrapingJob(db.Model):
-    id = db.Column(db.String(36), primary_key=True)
-    status = db.Column(db.String(20), default='pending')
-    total_urls = db.Column(db.Integer, default=0)
-    completed_urls = db.Column(db.Integer, default=0)
-    failed_urls = db.Column(db.Integer, default=0)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    completed_at = db.Column(db.DateTime)
-    current_url = db.Column(db.String(500))
-    error_message = db.Column(db.Text)
-
-class Product(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    job_id = db.Column(db.String(36), db.ForeignKey('scraping_job.id'))
-    title = db.Column(db.String(500))
-    price = db.Column(db.String(50))
-    description = db.Column(db.Text)
-    part_number = db.Column(db.String(100))
-    ean = db.Column(db.String(50))
-    brand = db.Column(db.String(100))
-    color = db.Column(db.String(50))
-    condition = db.Column(db.String(50))
-    image_url = db.Column(db.String(500))
-    additional_images = db.Column(db.Text)
-    source_url = db.Column(db.String(500))
-    features = db.Column(db.Text)
-    availability = db.Column(db.String(100))
-    scraped_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-class UniversalProductScraper:
-    def __init__(self, delay=3):
-        self.delay = delay
-        self.session = requests.Session()
-        
-        # More realistic browser headers to avoid blocking
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'en-GB,en;q=0.9,en-US;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Cache-Control': 'max-age=0'
-        })
-    
-    def scrape_product(self, url):
-        """Universal product scraper with better encoding handling"""
-        try:
-            logger.info(f"Universal scraping: {url}")
-            
-            # Random delay to appear more human
-            delay = random.uniform(self.delay, self.delay + 2)
-            time.sleep(delay)
-            
-            response = self.session.get(url, timeout=20, allow_redirects=True)
-            response.raise_for_status()
-            
-            # Fix encoding issues
-            response.encoding = response.apparent_encoding or 'utf-8'
-            
-            soup = BeautifulSoup(response.content, 'html.parser', from_encoding='utf-8')
-            product_data = self.extract_product_data(soup, url)
-            
-            # Longer delay after successful scrape
-            time.sleep(random.uniform(2, 5))
-            return product_data
-            
-        except Exception as e:
-            logger.error(f"Error scraping {url}: {str(e)}")
-            return None
-
-    def extract_product_data(self, soup, url):
-        """Fixed extraction with better encoding and debug info"""
-        product = {'source_url': url}
-        
-        # Get page text with better encoding handling
-        try:
-            page_text = soup.get_text(separator=' ', strip=True)
-        except:
-            page_text = str(soup.get_text())
-        
-        # Clean up encoding issues
-        page_text = page_text.encode('utf-8', errors='ignore').decode('utf-8')
-        
-        logger.info(f"=== DEBUG INFO FOR {url} ===")
-        logger.info(f"Page text length: {len(page_text)}")
-        logger.info(f"First 500 chars: {repr(page_text[:500])}")
-        
-        # TITLE EXTRACTION - Multiple methods
-        title = None
-        
-        # Method 1: Page title tag
-        title_tag = soup.find('title')
-        if title_tag:
-            title = title_tag.get_text(strip=True)
-            logger.info(f"Found title tag: {repr(title)}")
-        
-        # Method 2: H1 tags
-        if not title:
-            h1_tags = soup.find_all('h1')
-            for h1 in h1_tags:
-                h1_text = h1.get_text(strip=True)
-                if h1_text and len(h1_text) > 5:
-                    title = h1_text
-                    logger.info(f"Found H1 title: {repr(title)}")
-                    break
-        
-        # Method 3: Product name selectors
-        if not title:
-            selectors = ['.product-name', '.product-title', '.entry-title', '[data-testid="product-title"]']
-            for selector in selectors:
-                element = soup.select_one(selector)
-                if element:
-                    title = element.get_text(strip=True)
-                    logger.info(f"Found title with selector {selector}: {repr(title)}")
-                    break
-        
-        if title:
-            # Clean up title
-            for suffix in [' - Best4Systems', ' | Best4Systems', ' - PMC Telecom', ' - Headset Store']:
-                title = re.sub(re.escape(suffix) + r'.*$', '', title, flags=re.IGNORECASE)
-            product['title'] = title.strip()
-            logger.info(f"Final title: {repr(product['title'])}")
-        
-        # PART NUMBER EXTRACTION - Look for specific patterns
-        logger.info("=== LOOKING FOR PART NUMBERS ===")
-        
-        # Look for "part number: XXXXX" pattern specifically
-        part_patterns = [
-            r'part number[:\s]+([A-Z0-9\-]+)',
-            r'product code[:\s]+([A-Z0-9\-]+)',
-            r'model[:\s]+([A-Z0-9\-]+)',
-            r'MPN[:\s]+([A-Z0-9\-]+)',
-            r'SKU[:\s]+([A-Z0-9\-]+)',
-        ]
-        
-        for pattern in part_patterns:
-            matches = re.findall(pattern, page_text, re.IGNORECASE)
-            if matches:
-                logger.info(f"Pattern '{pattern}' found: {matches}")
-                for match in matches:
-                    if 3 <= len(match) <= 20:  # Reasonable length
-                        product['part_number'] = match
-                        logger.info(f"Using part number: {match}")
-                        break
-                if 'part_number' in product:
-                    break
-        
-        # If no part number found, look for likely candidates
-        if 'part_number' not in product:
-            potential_parts = re.findall(r'\b[A-Z]{2,}[0-9\-]{2,}\b', page_text)
-            if potential_parts:
-                logger.info(f"Potential part numbers: {potential_parts[:5]}")
-                product['part_number'] = potential_parts[0]
-        
-        # BRAND EXTRACTION
-        logger.info("=== LOOKING FOR BRANDS ===")
-        
-        # First check title for known brands
-        if 'title' in product:
-            title_lower = product['title'].lower()
-            brands = ['plantronics', 'poly', 'epos', 'sennheiser', 'jabra', 'logitech', 'project telecom', 'cisco', 'yealink']
-            for brand in brands:
-                if brand in title_lower:
-                    product['brand'] = brand.title()
-                    logger.info(f"Found brand in title: {brand}")
-                    break
-        
-        # Check page text for brand patterns
-        if 'brand' not in product:
-            brand_lines = []
-            lines = page_text.split('\n')
-            for line in lines:
-                if any(word in line.lower() for word in ['brand', 'manufacturer', 'made by']):
-                    brand_lines.append(line.strip())
-            
-            if brand_lines:
-                logger.info(f"Brand-related lines: {brand_lines[:3]}")
-        
-        # PRICE EXTRACTION (already working, but let's improve it)
-        logger.info("=== LOOKING FOR PRICES ===")
-        price_patterns = [
-            r'£\s*([\d,]+\.?\d*)',
-            r'\$\s*([\d,]+\.?\d*)',
-            r'€\s*([\d,]+\.?\d*)',
-            r'GBP\s*([\d,]+\.?\d*)',
-            r'USD\s*([\d,]+\.?\d*)',
-        ]
-        
-        for pattern in price_patterns:
-            matches = re.findall(pattern, page_text)
-            if matches:
-                logger.info(f"Price pattern '{pattern}' found: {matches}")
-                for match in matches:
-                    try:
-                        price_float = float(match.replace(',', ''))
-                        if 1 <= price_float <= 10000:  # Reasonable range
-                            currency = '£' if '£' in pattern else ('$' if '$' in pattern else '€')
-                            product['price'] = f"{currency}{match}"
-                            logger.info(f"Using price: {product['price']}")
-                            break
-                    except:
-                        continue
-                if 'price' in product:
-                    break
-        
-        # DESCRIPTION EXTRACTION
-        logger.info("=== LOOKING FOR DESCRIPTIONS ===")
-        
-        # Look for description in meta tags
-        meta_desc = soup.find('meta', attrs={'name': 'description'})
-        if meta_desc and meta_desc.get('content'):
-            desc = meta_desc.get('content').strip()
-            if len(desc) > 20:
-                product['description'] = desc
-                logger.info(f"Found meta description: {desc[:100]}")
-        
-        # Look for product descriptions in common containers
-        if 'description' not in product:
-            desc_selectors = [
-                '.product-description', '.description', '.product-details', 
-                '.product-info', '.entry-content', '[data-testid="description"]'
-            ]
-            
-            for selector in desc_selectors:
-                elements = soup.select(selector)
-                for element in elements:
-                    desc = element.get_text(strip=True)
-                    if 50 < len(desc) < 1000:
-                        product['description'] = desc[:500]  # Limit length
-                        logger.info(f"Found description with {selector}: {desc[:100]}")
-                        break
-                if 'description' in product:
-                    break
-        
-        # Look for paragraph descriptions
-        if 'description' not in product:
-            paragraphs = soup.find_all('p')
-            for para in paragraphs:
-                desc = para.get_text(strip=True)
-                if (100 < len(desc) < 800 and 
-                    not any(word in desc.lower() for word in ['cookie', 'privacy', 'delivery', 'return'])):
-                    product['description'] = desc
-                    logger.info(f"Found paragraph description: {desc[:100]}")
-                    break
-        
-        # Set defaults if nothing found
-        if 'title' not in product:
-            # Extract from URL as fallback
-            url_parts = url.split('/')
-            for part in reversed(url_parts):
-                if part and len(part) > 5 and '-' in part:
-                    title = part.replace('-', ' ').replace('.html', '').title()
-                    product['title'] = title
-                    logger.info(f"Generated title from URL: {title}")
-                    break
-            
-            if 'title' not in product:
-                product['title'] = f"Product from {url.split('//')[-1].split('/')[0]}"
-        
-        if 'description' not in product:
-            product['description'] = f"Professional {product.get('title', 'product')} with advanced features."
-        
-        product['availability'] = 'Available'
-        
-        # FINAL DEBUG OUTPUT
-        logger.info(f"=== FINAL EXTRACTION RESULTS FOR {url} ===")
-        for key, value in product.items():
-            if key != 'source_url':
-                display_value = str(value)[:150] + ('...' if len(str(value)) > 150 else '')
-                logger.info(f"{key.title()}: {display_value}")
-        logger.info("=== END EXTRACTION RESULTS ===")
-        
-        return product
-
-def scrape_urls_background(job_id, urls):
-    """Background function to scrape URLs"""
-    with app.app_context():
-        job = ScrapingJob.query.get(job_id)
-        scraper = UniversalProductScraper(delay=3)
-        
-        try:
-            job.status = 'running'
-            db.session.commit()
-            
-            for i, url in enumerate(urls):
-                job.current_url = url
-                job.completed_urls = i
-                db.session.commit()
-                
-                # Scrape the product
-                product_data = scraper.scrape_product(url)
-                
-                if product_data:
-                    # Save to database
-                    product = Product(
-                        job_id=job_id,
-                        title=product_data.get('title'),
-                        price=product_data.get('price'),
-                        description=product_data.get('description'),
-                        part_number=product_data.get('part_number'),
-                        ean=product_data.get('ean'),
-                        brand=product_data.get('brand'),
-                        color=product_data.get('color'),
-                        condition=product_data.get('condition'),
-                        image_url=product_data.get('image_url'),
-                        additional_images=product_data.get('additional_images'),
-                        source_url=product_data.get('source_url'),
-                        features=product_data.get('features'),
-                        availability=product_data.get('availability')
-                    )
-                    db.session.add(product)
-                    db.session.commit()
-                    logger.info(f"Saved product: {product_data.get('title', 'Unknown')}")
-                else:
-                    job.failed_urls += 1
-                    logger.warning(f"Failed to scrape: {url}")
-            
-            # Mark job as completed
-            job.status = 'completed'
-            job.completed_at = datetime.utcnow()
-            job.completed_urls = len(urls)
-            db.session.commit()
-            
-            logger.info(f"Scraping job {job_id} completed successfully")
-            
-        except Exception as e:
-            job.status = 'failed'
-            job.error_message = str(e)
-            db.session.commit()
-            logger.error(f"Scraping job {job_id} failed: {str(e)}")
-
-# API Routes
-@app.route('/')
-def index():
-    """Serve the main page"""
-    return render_template('index.html')
-
-@app.route('/api/scrape', methods=['POST'])
-def start_scraping():
-    """Start a new scraping job"""
-    try:
-        data = request.get_json()
-        
-        if not data or 'urls' not in data:
-            return jsonify({'error': 'No URLs provided'}), 400
-        
-        urls = [url.strip() for url in data['urls'] if url.strip()]
-        
-        if not urls:
-            return jsonify({'error': 'No valid URLs provided'}), 400
-        
-        # Create new job
-        job_id = str(uuid.uuid4())
-        job = ScrapingJob(
-            id=job_id,
-            total_urls=len(urls),
-            status='pending'
-        )
-        db.session.add(job)
-        db.session.commit()
-        
-        # Start background scraping
-        thread = threading.Thread(target=scrape_urls_background, args=(job_id, urls))
-        thread.daemon = True
-        thread.start()
-        
-        return jsonify({
-            'job_id': job_id,
-            'status': 'started',
-            'total_urls': len(urls)
-        })
-        
-    except Exception as e:
-        logger.error(f"Error starting scraping job: {str(e)}")
-        return jsonify({'error': 'Internal server error'}), 500
-
-@app.route('/api/job/<job_id>/status')
-def get_job_status(job_id):
-    """Get the status of a scraping job"""
-    try:
-        job = ScrapingJob.query.get(job_id)
-        
-        if not job:
-            return jsonify({'error': 'Job not found'}), 404
-        
-        return jsonify({
-            'id': job.id,
-            'status': job.status,
-            'total_urls': job.total_urls,
-            'completed_urls': job.completed_urls,
-            'failed_urls': job.failed_urls,
-            'current_url': job.current_url,
-            'progress': (job.completed_urls / job.total_urls * 100) if job.total_urls > 0 else 0,
-            'error_message': job.error_message
-        })
-        
-    except Exception as e:
-        logger.error(f"Error getting job status: {str(e)}")
-        return jsonify({'error': 'Internal server error'}), 500
-
-@app.route('/api/job/<job_id>/products')
-def get_job_products(job_id):
-    """Get all products from a scraping job"""
-    try:
-        job = ScrapingJob.query.get(job_id)
-        
-        if not job:
-            return jsonify({'error': 'Job not found'}), 404
-        
-        products = Product.query.filter_by(job_id=job_id).all()
-        
-        product_data = []
-        for product in products:
-            product_data.append({
-                'id': product.id,
-                'title': product.title,
-                'price': product.price,
-                'description': product.description,
-                'part_number': product.part_number,
-                'ean': product.ean,
-                'brand': product.brand,
-                'color': product.color,
-                'condition': product.condition,
-                'image_url': product.image_url,
-                'additional_images': product.additional_images,
-                'source_url': product.source_url,
-                'features': product.features,
-                'availability': product.availability
-            })
-        
-        return jsonify({'products': product_data})
-        
-    except Exception as e:
-        logger.error(f"Error getting job products: {str(e)}")
-        return jsonify({'error': 'Internal server error'}), 500
-
-@app.route('/api/job/<job_id>/export/shopify')
-def export_shopify_csv(job_id):
-    """Export products as Shopify CSV"""
-    try:
-        job = ScrapingJob.query.get(job_id)
-        
-        if not job:
-            return jsonify({'error': 'Job not found'}), 404
-        
-        products = Product.query.filter_by(job_id=job_id).all()
-        
-        if not products:
-            return jsonify({'error': 'No products found'}), 404
-        
-        # Create CSV in memory
-        output = io.StringIO()
-        
-        # Shopify CSV headers
-        fieldnames = [
-            'Handle', 'Title', 'Body (HTML)', 'Vendor', 'Product Category', 'Type',
-            'Tags', 'Published', 'Option1 Name', 'Option1 Value', 'Option2 Name', 'Option2 Value',
-            'Option3 Name', 'Option3 Value', 'Variant SKU', 'Variant Grams', 'Variant Inventory Tracker',
-            'Variant Inventory Qty', 'Variant Inventory Policy', 'Variant Fulfillment Service',
-            'Variant Price', 'Variant Compare At Price', 'Variant Requires Shipping', 'Variant Taxable',
-            'Variant Barcode', 'Image Src', 'Image Position', 'Image Alt Text', 'Gift Card',
-            'SEO Title', 'SEO Description', 'Cost per item', 'Status'
-        ]
-        
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        for product in products:
-            # Generate handle from title
-            handle = ''
-            if product.title:
-                handle = re.sub(r'[^a-zA-Z0-9\s-]', '', product.title.lower())
-                handle = re.sub(r'\s+', '-', handle).strip('-')
-            
-            # Clean price
-            price = ''
-            if product.price:
-                price_match = re.search(r'([\d,]+\.?\d*)', product.price)
-                if price_match:
-                    price = price_match.group(1).replace(',', '')
-            
-            row = {
-                'Handle': handle,
-                'Title': product.title or '',
-                'Body (HTML)': product.description or '',
-                'Vendor': product.brand or '',
-                'Published': 'TRUE',
-                'Variant SKU': product.part_number or '',
-                'Variant Inventory Tracker': 'shopify',
-                'Variant Inventory Qty': '10',  # Default quantity
-                'Variant Inventory Policy': 'deny',
-                'Variant Fulfillment Service': 'manual',
-                'Variant Price': price,
-                'Variant Requires Shipping': 'TRUE',
-                'Variant Taxable': 'TRUE',
-                'Variant Barcode': product.ean or '',
-                'Image Src': product.image_url or '',
-                'Image Position': '1',
-                'Image Alt Text': product.title or '',
-                'Gift Card': 'FALSE',
-                'SEO Title': product.title or '',
-                'SEO Description': product.description[:160] if product.description else '',
-                'Status': 'active'
-            }
-            
-            writer.writerow(row)
-        
-        # Create file response
-        output.seek(0)
-        file_data = io.BytesIO(output.getvalue().encode('utf-8'))
-        
-        filename = f'shopify_products_{job_id[:8]}_{datetime.now().strftime("%Y%m%d")}.csv'
-        
-        return send_file(
-            file_data,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=filename
-        )
-        
-    except Exception as e:
-        logger.error(f"Error exporting CSV: {str(e)}")
-        return jsonify({'error': 'Internal server error'}), 500
-
-@app.route('/api/jobs')
-def list_jobs():
-    """List all scraping jobs"""
-    try:
-        jobs = ScrapingJob.query.order_by(ScrapingJob.created_at.desc()).limit(20).all()
-        
-        job_data = []
-        for job in jobs:
-            job_data.append({
-                'id': job.id,
-                'status': job.status,
-                'total_urls': job.total_urls,
-                'completed_urls': job.completed_urls,
-                'failed_urls': job.failed_urls,
-                'created_at': job.created_at.isoformat(),
-                'completed_at': job.completed_at.isoformat() if job.completed_at else None
-            })
-        
-        return jsonify({'jobs': job_data})
-        
-    except Exception as e:
-        logger.error(f"Error listing jobs: {str(e)}")
-        return jsonify({'error': 'Internal server error'}), 500
-
-# Health check endpoint
-@app.route('/health')
-def health_check():
-    """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
-
-if __name__ == '__main__':
-    # Get port from environment variable for deployment
-    port = int(os.environ.get('PORT', 5000))
-    
-    # Create database tables
-    with app.app_context():
-        db.create_all()
-        logger.info("Database tables created successfully")
-    
-    # Run the app
-    logger.info(f"Starting app on port {port}")
-    app.run(debug=False, host='0.0.0.0', port=port)
+# app.py - Fixed Universal E-commerce Product Scraper with Better Encoding
+import os
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
+from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy
+from flask_cors import CORS
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from bs4 import BeautifulSoup, FeatureNotFound
+import time
+import re
+import csv
+import io
+import uuid
+import socket
+from datetime import datetime, timedelta
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+from email.utils import parsedate_to_datetime
+from xml.etree import ElementTree
+import threading
+import logging
+import random
+import json
+import html
+import codecs
+import contextlib
+import sqlite3
+import hashlib
+import zlib
+import heapq
+import itertools
+import queue
+from collections import deque, OrderedDict
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Initialize Flask app
+app = Flask(__name__)
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
+# postgresql:// URLs need psycopg2; some hosts still hand out the old postgres:// scheme
+app.config['SQLALCHEMY_DATABASE_URI'] = re.sub(
+    r'^postgres://', 'postgresql://', os.environ.get('DATABASE_URL', 'sqlite:///products.db')
+)
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Scraper settings
+app.config['SCRAPER_CONCURRENCY'] = int(os.environ.get('SCRAPER_CONCURRENCY', 8))
+app.config['SCRAPER_HOST_DELAY'] = float(os.environ.get('SCRAPER_HOST_DELAY', 3))
+app.config['SCRAPER_HOST_JITTER'] = float(os.environ.get('SCRAPER_HOST_JITTER', 2))
+app.config['SCRAPER_HOST_MAX_RATE'] = float(os.environ.get('SCRAPER_HOST_MAX_RATE', 5))  # requests per second
+app.config['SCRAPER_MAX_RETRIES'] = int(os.environ.get('SCRAPER_MAX_RETRIES', 3))
+app.config['SCRAPER_RETRY_BASE_DELAY'] = float(os.environ.get('SCRAPER_RETRY_BASE_DELAY', 2))
+app.config['SCRAPER_EXTRACT_PROCESSES'] = int(os.environ.get('SCRAPER_EXTRACT_PROCESSES', 0))
+app.config['SCRAPER_PARSER'] = os.environ.get('SCRAPER_PARSER', 'html.parser')
+
+# Product pages are streamed and cut off after SCRAPER_MAX_PAGE_MB; with
+# SCRAPER_EARLY_STOP, reading also stops once structured data gives a complete record
+app.config['SCRAPER_MAX_PAGE_MB'] = float(os.environ.get('SCRAPER_MAX_PAGE_MB', 5))
+app.config['SCRAPER_EARLY_STOP'] = os.environ.get('SCRAPER_EARLY_STOP', '').lower() in ('1', 'true', 'yes')
+
+# Extraction tracing: pages from SCRAPER_TRACE_HOSTS (comma-separated) and a random
+# SCRAPER_TRACE_SAMPLE fraction of the rest log their extraction decisions on the
+# app.extract logger
+app.config['SCRAPER_TRACE_SAMPLE'] = float(os.environ.get('SCRAPER_TRACE_SAMPLE', 0))
+app.config['SCRAPER_TRACE_HOSTS'] = [
+    host.strip().lower() for host in os.environ.get('SCRAPER_TRACE_HOSTS', '').split(',') if host.strip()
+]
+app.config['SCRAPER_DB_BATCH_SIZE'] = int(os.environ.get('SCRAPER_DB_BATCH_SIZE', 50))
+app.config['SCRAPER_DB_FLUSH_INTERVAL'] = float(os.environ.get('SCRAPER_DB_FLUSH_INTERVAL', 2))
+app.config['SCRAPER_PIPELINE_BUFFER'] = int(os.environ.get('SCRAPER_PIPELINE_BUFFER', 0))  # 0 = 4 x concurrency
+app.config['SCRAPER_HTTP_CACHE_DIR'] = os.environ.get('SCRAPER_HTTP_CACHE_DIR', '')
+app.config['SCRAPER_HTTP_CACHE_MAX_MB'] = int(os.environ.get('SCRAPER_HTTP_CACHE_MAX_MB', 512))
+
+# Results shared between jobs: a URL scraped in the last SCRAPER_RESULT_CACHE_TTL
+# seconds (0 disables) isn't fetched again, keeping up to SCRAPER_RESULT_CACHE_SIZE results
+app.config['SCRAPER_RESULT_CACHE_TTL'] = float(os.environ.get('SCRAPER_RESULT_CACHE_TTL', 300))
+app.config['SCRAPER_RESULT_CACHE_SIZE'] = int(os.environ.get('SCRAPER_RESULT_CACHE_SIZE', 10000))
+
+# Shared HTTP client: connection pools are kept for SCRAPER_POOL_HOSTS hosts with up to
+# SCRAPER_POOL_PER_HOST keep-alive connections each; SCRAPER_HTTP2 needs httpx[http2]
+app.config['SCRAPER_POOL_HOSTS'] = int(os.environ.get('SCRAPER_POOL_HOSTS', 100))
+app.config['SCRAPER_POOL_PER_HOST'] = int(os.environ.get('SCRAPER_POOL_PER_HOST', 4))
+app.config['SCRAPER_HTTP2'] = os.environ.get('SCRAPER_HTTP2', '').lower() in ('1', 'true', 'yes')
+
+# Job queue settings: 'thread' runs each job on a thread in the web process,
+# 'queue' leaves jobs in the database for worker.py processes to claim
+app.config['SCRAPER_WORKER_MODE'] = os.environ.get('SCRAPER_WORKER_MODE', 'thread')
+app.config['SCRAPER_LEASE_SECONDS'] = float(os.environ.get('SCRAPER_LEASE_SECONDS', 60))
+app.config['SCRAPER_WORKER_POLL_SECONDS'] = float(os.environ.get('SCRAPER_WORKER_POLL_SECONDS', 2))
+
+# Job scheduling: every job in a process shares SCRAPER_GLOBAL_CONCURRENCY fetch slots,
+# each process (the web app in thread mode, or a worker.py process) runs up to
+# SCRAPER_MAX_ACTIVE_JOBS jobs at once plus SCRAPER_PRIORITY_RUNNERS high priority
+# ones, so interactive jobs start even while large jobs fill the other runners,
+# and jobs of up to SCRAPER_INTERACTIVE_URLS URLs default to high priority
+app.config['SCRAPER_GLOBAL_CONCURRENCY'] = int(os.environ.get('SCRAPER_GLOBAL_CONCURRENCY', 16))
+app.config['SCRAPER_MAX_ACTIVE_JOBS'] = int(os.environ.get('SCRAPER_MAX_ACTIVE_JOBS', 4))
+app.config['SCRAPER_PRIORITY_RUNNERS'] = int(os.environ.get('SCRAPER_PRIORITY_RUNNERS', 2))
+app.config['SCRAPER_INTERACTIVE_URLS'] = int(os.environ.get('SCRAPER_INTERACTIVE_URLS', 50))
+
+# Initialize extensions
+db = SQLAlchemy(app)
+CORS(app)
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    """WAL lets API reads carry on while a job writes, and a busy timeout makes
+    concurrent writers wait their turn rather than fail with 'database is locked'"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')  # durable at each WAL checkpoint, not every commit
+    cursor.execute('PRAGMA busy_timeout=10000')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 MB
+    cursor.close()
+
+# Database Models
+class ScrapingJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    status = db.Column(db.String(20), default='pending', index=True)
+    total_urls = db.Column(db.Integer, default=0)
+    completed_urls = db.Column(db.Integer, default=0)
+    failed_urls = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    completed_at = db.Column(db.DateTime)
+    current_url = db.Column(db.String(500))
+    error_message = db.Column(db.Text)
+    job_type = db.Column(db.String(20), default='scrape')  # 'scrape', 'refresh' or 'discover'
+    unchanged_urls = db.Column(db.Integer, default=0)
+    refresh_job_id = db.Column(db.String(36))
+    start_url = db.Column(db.String(500))  # store root for discovery jobs
+    worker_id = db.Column(db.String(100))  # worker holding the lease while running
+    lease_expires_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    timings = db.Column(db.Text)  # JSON stage timing totals, see JobTimings
+    priority = db.Column(db.String(20), default='normal')  # see PRIORITY_WEIGHTS
+    started_at = db.Column(db.DateTime)  # claimed by the current worker
+    started_urls = db.Column(db.Integer)  # completed_urls when the current worker claimed it
+
+class JobUrl(db.Model):
+    """One URL queued for a job; pending URLs are what's left when a job resumes"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(36), db.ForeignKey('scraping_job.id'), index=True)
+    position = db.Column(db.Integer)
+    url = db.Column(db.String(500))
+    status = db.Column(db.String(20), default='pending')  # 'pending', 'done' or 'failed'
+    attempts = db.Column(db.Integer, default=0)
+    failure_kind = db.Column(db.String(20))  # 'transient', 'permanent' or 'blocked'
+    error = db.Column(db.String(500))
+
+class HostPolicy(db.Model):
+    """Request rate learned for a host, carried over to later jobs"""
+    host = db.Column(db.String(255), primary_key=True)
+    rate = db.Column(db.Float)  # requests per second
+    latency = db.Column(db.Float)  # moving average response time in seconds
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Product(db.Model):
+    __table_args__ = (
+        # Serves filter_by(job_id=...) and the keyset pages ordered by id within a job
+        db.Index('ix_product_job_id_id', 'job_id', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(36), db.ForeignKey('scraping_job.id'))
+    title = db.Column(db.String(500))
+    price = db.Column(db.String(50))
+    description = db.Column(db.Text)
+    part_number = db.Column(db.String(100))
+    ean = db.Column(db.String(50))
+    brand = db.Column(db.String(100))
+    color = db.Column(db.String(50))
+    condition = db.Column(db.String(50))
+    image_url = db.Column(db.String(500))
+    additional_images = db.Column(db.Text)
+    source_url = db.Column(db.String(500), index=True)
+    features = db.Column(db.Text)
+    availability = db.Column(db.String(100))
+    content_hash = db.Column(db.String(64))
+    scraped_at = db.Column(db.DateTime, default=datetime.utcnow)
+    checked_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class TokenBucket:
+    """Token bucket used to space out requests to a single host"""
+    def __init__(self, rate, capacity=1):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self, extra_delay=0):
+        """Take a token, optionally pushing the next one further out"""
+        self._refill(time.monotonic())
+        self.tokens -= 1 + extra_delay * self.rate
+    
+    def hold(self, seconds):
+        """Make sure no token is available for at least `seconds`"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+# Adaptive politeness: a host's request rate is halved on 429/503 responses or
+# failed requests, eased back when responses slow down, and otherwise raised a
+# step at a time while the host keeps answering quickly
+HOST_MIN_RATE = 1 / 120.0  # requests per second
+HOST_RATE_STEP = 0.1
+HOST_BACKOFF_FACTOR = 0.5
+HOST_SLOWDOWN_FACTOR = 0.8
+HOST_SLOW_LATENCY_RATIO = 2.0
+HOST_MAX_RETRY_AFTER = 600
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delay-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at is None:
+            return None
+        seconds = (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()
+    return min(max(seconds, 0), HOST_MAX_RETRY_AFTER)
+
+# Failure classes: transient failures are retried, permanent ones (missing pages,
+# pages that can't be extracted) and blocked ones (the site refusing the scraper)
+# are not
+BLOCKED_STATUS_CODES = (401, 403, 407, 451)
+RETRY_MAX_DELAY = 60
+
+def classify_failure(error):
+    """Return ('transient' | 'permanent' | 'blocked', reason) for a scraping exception"""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        reason = f"HTTP {status}"
+        if status in BLOCKED_STATUS_CODES:
+            return 'blocked', reason
+        if status == 429 or status >= 500:
+            return 'transient', reason
+        return 'permanent', reason
+    if isinstance(error, requests.Timeout):
+        return 'transient', f"Timeout: {str(error)}"
+    if isinstance(error, requests.ConnectionError):
+        return 'transient', f"Connection error: {str(error)}"
+    if isinstance(error, requests.RequestException):
+        return 'permanent', f"Request error: {str(error)}"
+    if isinstance(error, BrokenProcessPool):
+        return 'transient', f"Extraction worker died: {str(error)}"
+    return 'permanent', f"{type(error).__name__}: {str(error)}"
+
+def retry_delay(attempt, base_delay=2):
+    """Jittered exponential backoff: between base_delay / 2 and base_delay * 2^attempt seconds"""
+    return random.uniform(base_delay / 2, min(RETRY_MAX_DELAY, base_delay * 2 ** attempt))
+
+class HostRateLimiter:
+    """Per-host token buckets whose rates adapt to how each host responds.
+    
+    Hosts start at one request per `delay` seconds, or at the rate learned for
+    them in earlier jobs. observe() feeds back each response: 429 and 503
+    responses, timeouts and connection errors halve the rate and Retry-After
+    holds the host back for as long as it asks; responses noticeably slower
+    than the host's average ease the rate back; other successful responses
+    raise it by HOST_RATE_STEP up to `max_rate`.
+    """
+    def __init__(self, delay=3, jitter=2, max_rate=5):
+        self.delay = delay
+        self.jitter = jitter
+        self.max_rate = max_rate
+        self.initial_rate = 1.0 / delay if delay > 0 else float('inf')
+        self.buckets = {}
+        self.latency = {}  # host -> moving average response time in seconds
+        self.learned = {}  # host -> (rate, latency) from earlier jobs
+        self.changed = set()
+        self.lock = threading.Lock()
+    
+    def learn(self, policies):
+        """Start hosts at previously learned rates; policies maps host -> (rate, latency)"""
+        with self.lock:
+            self.learned.update(policies)
+    
+    def bucket(self, host):
+        with self.lock:
+            return self._bucket(host)
+    
+    def _bucket(self, host):
+        if host not in self.buckets:
+            rate = self.initial_rate
+            if host in self.learned:
+                rate, latency = self.learned[host]
+                if latency:
+                    self.latency[host] = latency
+            self.buckets[host] = TokenBucket(rate=rate)
+        return self.buckets[host]
+    
+    def wait_time(self, host):
+        bucket = self.bucket(host)
+        with self.lock:
+            return bucket.wait_time()
+    
+    def consume(self, host):
+        bucket = self.bucket(host)
+        with self.lock:
+            # Random jitter on top of the base delay to appear more human, kept
+            # within one interval so it doesn't cancel out a faster learned rate
+            bucket.consume(extra_delay=random.uniform(0, min(self.jitter, 1.0 / bucket.rate)))
+    
+    def observe(self, host, latency=None, status=None, retry_after=None):
+        """Adjust a host's rate after a request; status None means the request failed"""
+        with self.lock:
+            bucket = self._bucket(host)
+            if bucket.rate == float('inf'):
+                return
+            
+            if status is None or status in (429, 503):
+                bucket.rate = max(HOST_MIN_RATE, bucket.rate * HOST_BACKOFF_FACTOR)
+                wait = parse_retry_after(retry_after)
+                if wait:
+                    bucket.hold(wait)
+                logger.info(f"Backing off {host} to {bucket.rate:.3f} req/s")
+            elif status < 400:
+                average = self.latency.get(host)
+                if average and latency > average * HOST_SLOW_LATENCY_RATIO:
+                    bucket.rate = max(HOST_MIN_RATE, bucket.rate * HOST_SLOWDOWN_FACTOR)
+                else:
+                    bucket.rate = min(self.max_rate, bucket.rate + HOST_RATE_STEP)
+                self.latency[host] = latency if average is None else average * 0.8 + latency * 0.2
+            else:
+                return
+            self.changed.add(host)
+    
+    def policies(self):
+        """{host: (rate, latency)} for hosts whose rate changed since it was last saved"""
+        with self.lock:
+            return {host: (self.buckets[host].rate, self.latency.get(host)) for host in self.changed}
+    
+    def mark_saved(self, policies):
+        """Forget the hosts in `policies` once they're stored, unless they've changed again since"""
+        with self.lock:
+            for host, policy in policies.items():
+                if (self.buckets[host].rate, self.latency.get(host)) == policy:
+                    self.changed.discard(host)
+
+# Job priorities and their share of the fetch slots relative to each other
+PRIORITY_WEIGHTS = {'low': 1, 'normal': 4, 'high': 16}
+
+class JobShare:
+    """A job's standing in the FetchScheduler"""
+    def __init__(self, weight, wake, vtime):
+        self.weight = weight
+        self.wake = wake
+        self.vtime = vtime  # slots used so far, divided by weight
+        self.waiting = False
+        self.in_flight = 0
+
+class FetchScheduler:
+    """Fetch slots shared by every job running in the process.
+    
+    At most `slots` requests are in flight across all jobs, and jobs share one
+    HostRateLimiter, so host limits hold however many jobs hit the same host.
+    A free slot goes to the waiting job that has had the fewest slots for its
+    weight (stride scheduling), so a large job can't starve a small one and
+    higher priority jobs get proportionally more of the capacity.
+    
+    Job dispatchers never block here: try_acquire() either grants a slot or
+    marks the job as waiting, and the job's `wake` callback is called when a
+    slot may be free for it.
+    """
+    def __init__(self, slots, rate_limiter):
+        self.slots = max(1, slots)
+        self.rate_limiter = rate_limiter
+        self.lock = threading.Lock()
+        self.shares = []
+        self.in_use = 0
+    
+    def register(self, weight, wake):
+        with self.lock:
+            # Start level with the jobs already running rather than ahead of them
+            share = JobShare(weight, wake, min((other.vtime for other in self.shares), default=0.0))
+            self.shares.append(share)
+        return share
+    
+    def unregister(self, share):
+        with self.lock:
+            self.shares.remove(share)
+            self.in_use -= share.in_flight
+            share.in_flight = 0
+            turn = self._next_turn()
+        if turn:
+            turn.wake()
+    
+    def _next_turn(self):
+        if self.in_use >= self.slots:
+            return None
+        waiting = [share for share in self.shares if share.waiting]
+        return min(waiting, key=lambda share: share.vtime) if waiting else None
+    
+    def try_acquire(self, share):
+        """Take a slot for one fetch if it's this job's turn"""
+        with self.lock:
+            if not share.waiting:
+                # A job coming back from idle doesn't get credit for the time it sat out
+                waiting = [other.vtime for other in self.shares if other.waiting]
+                if waiting:
+                    share.vtime = max(share.vtime, min(waiting))
+            
+            turn = None
+            if self.in_use < self.slots:
+                turn = min((other for other in self.shares if other.waiting or other is share), key=lambda other: other.vtime)
+                if turn is share:
+                    self.in_use += 1
+                    share.in_flight += 1
+                    share.vtime += 1.0 / share.weight
+                    share.waiting = False
+                    return True
+            share.waiting = True
+        if turn:
+            turn.wake()
+        return False
+    
+    def release(self, share):
+        with self.lock:
+            self.in_use -= 1
+            share.in_flight -= 1
+            turn = self._next_turn()
+        if turn:
+            turn.wake()
+    
+    def idle(self, share):
+        """The job has nothing ready to fetch, so pass its turn on"""
+        with self.lock:
+            if not share.waiting:
+                return
+            share.waiting = False
+            turn = self._next_turn()
+        if turn:
+            turn.wake()
+
+class PipelineStats:
+    """Queue depth and throughput of each stage of the scraping pipeline.
+    
+    'fetch' counts requests in flight, 'parse' pages waiting for or under
+    extraction, and 'persist' results waiting for the database writer.
+    """
+    STAGES = ('fetch', 'parse', 'persist')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.queued = dict.fromkeys(self.STAGES, 0)
+        self.processed = dict.fromkeys(self.STAGES, 0)
+    
+    def enter(self, stage):
+        with self.lock:
+            self.queued[stage] += 1
+    
+    def leave(self, stage):
+        with self.lock:
+            self.queued[stage] -= 1
+            self.processed[stage] += 1
+    
+    def snapshot(self):
+        """{stage: {'queued', 'processed', 'per_second'}} for status payloads and logs"""
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        with self.lock:
+            return {
+                stage: {
+                    'queued': self.queued[stage],
+                    'processed': self.processed[stage],
+                    'per_second': round(self.processed[stage] / elapsed, 2)
+                }
+                for stage in self.STAGES
+            }
+    
+    def summary(self):
+        return ', '.join(
+            f"{stage} {stats['queued']} queued {stats['per_second']}/s"
+            for stage, stats in self.snapshot().items()
+        )
+
+# Metrics
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help) for everything exported on /metrics
+METRICS = {
+    'scraper_stage_seconds': (
+        'histogram', 'Time spent per page in each scraping stage (connect is DNS, TCP and TLS for new connections)'),
+    'scraper_extract_field_seconds': ('histogram', 'Time spent extracting each field from a parsed page'),
+    'scraper_responses_total': ('counter', 'HTTP responses by host and status code'),
+    'scraper_request_errors_total': ('counter', 'Requests that failed without a response, by host'),
+    'scraper_downloaded_bytes_total': ('counter', 'Response body bytes downloaded, by host'),
+    'scraper_http_cache_total': ('counter', 'HTTP cache lookups by result (hit, revalidated or miss)'),
+    'scraper_pages_total': ('counter', 'Scraped URLs by outcome (saved, unchanged or failed)'),
+    'scraper_result_cache_total': ('counter', 'Result cache lookups by result (hit, coalesced or miss)'),
+}
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Metrics:
+    """Process-wide counters and histograms, rendered in the Prometheus text format"""
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+    
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+        
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {values[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class JobTimings:
+    """Per-job totals of the stage and field timings also sent to `metrics`"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # stage -> [count, total seconds, max seconds]
+    
+    def record(self, stage, seconds):
+        if stage.startswith('extract.'):
+            metrics.observe('scraper_extract_field_seconds', seconds, field=stage[len('extract.'):])
+        else:
+            metrics.observe('scraper_stage_seconds', seconds, stage=stage)
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+    
+    def record_all(self, timings):
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+    
+    def snapshot(self):
+        """{stage: {'count', 'total_seconds', 'mean_seconds', 'max_seconds'}}"""
+        with self.lock:
+            return {
+                stage: {
+                    'count': count,
+                    'total_seconds': round(total, 6),
+                    'mean_seconds': round(total / count, 6) if count else 0,
+                    'max_seconds': round(longest, 6)
+                }
+                for stage, (count, total, longest) in sorted(self.stages.items())
+            }
+
+def lap(timings, stage, since):
+    """Add the time since `since` to timings[stage] when timing, returning the current time"""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + now - since
+    return now
+
+# Extraction tracing
+trace_logger = logging.getLogger(__name__ + '.extract')
+
+class ExtractionTrace:
+    """The decisions made while extracting one page, logged as one JSON line"""
+    def __init__(self, url):
+        self.url = url
+        self.steps = []
+    
+    def add(self, step, **details):
+        self.steps.append({'step': step, **details})
+    
+    def emit(self, product):
+        result = {field: value for field, value in product.items() if field != 'source_url'}
+        trace_logger.info(json.dumps(
+            {'url': self.url, 'steps': self.steps, 'result': result},
+            ensure_ascii=False,
+            default=str
+        ))
+
+class ExtractionTracer:
+    """Picks the pages that get an ExtractionTrace: every page on `hosts` and a
+    random `sample` fraction of the rest.
+    
+    start() returns None for everything else, so untraced pages skip building
+    any trace details.
+    """
+    def __init__(self, sample=0.0, hosts=()):
+        self.sample = sample
+        self.hosts = frozenset(hosts)
+    
+    def start(self, url):
+        if not (self.sample or self.hosts) or not trace_logger.isEnabledFor(logging.INFO):
+            return None
+        if (self.hosts and urlparse(url).hostname in self.hosts) or random.random() < self.sample:
+            return ExtractionTrace(url)
+        return None
+
+# Lets the connection classes below credit connect time to the job making the request
+_request_context = threading.local()
+
+def _record_connect(seconds):
+    timings = getattr(_request_context, 'timings', None)
+    if timings is not None:
+        timings.record('connect', seconds)
+    else:
+        metrics.observe('scraper_stage_seconds', seconds, stage='connect')
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record_connect(time.perf_counter() - started)
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record_connect(time.perf_counter() - started)
+
+class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose new connections report how long DNS, TCP and TLS took"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+# HTML parser backends BeautifulSoup can build the tree with. 'lxml' is C-backed and
+# several times faster than the pure-Python 'html.parser' on large pages.
+PARSER_BACKENDS = ('html.parser', 'lxml')
+
+def resolve_parser(parser):
+    """Return a usable parser backend, falling back to html.parser if one isn't installed"""
+    if parser not in PARSER_BACKENDS:
+        logger.warning(f"Unknown parser backend {parser!r}, using html.parser")
+        return 'html.parser'
+    try:
+        BeautifulSoup('', parser)
+    except FeatureNotFound:
+        logger.warning(f"Parser backend {parser!r} is not installed, using html.parser")
+        return 'html.parser'
+    return parser
+
+def url_host(url):
+    """Host key used for per-domain throttling"""
+    return urlparse(url).netloc.lower()
+
+# Precompiled extraction rules, in priority order. The case-insensitive part number
+# rules run against a lowercased copy of the page text: CPython only uses its fast
+# literal-prefix search for case-sensitive patterns, which makes this several times
+# quicker than re.IGNORECASE. Each rule is scanned lazily and the first match that
+# passes the filters wins, so nothing past it is materialized.
+PART_NUMBER_RULES = [
+    re.compile(r'part number[:\s]+([a-z0-9\-]+)'),
+    re.compile(r'product code[:\s]+([a-z0-9\-]+)'),
+    re.compile(r'model[:\s]+([a-z0-9\-]+)'),
+    re.compile(r'mpn[:\s]+([a-z0-9\-]+)'),
+    re.compile(r'sku[:\s]+([a-z0-9\-]+)'),
+]
+PART_NUMBER_FALLBACK = re.compile(r'\b[A-Z]{2,}[0-9\-]{2,}\b')
+
+PRICE_RULES = [
+    (re.compile(r'£\s*([\d,]+\.?\d*)'), '£'),
+    (re.compile(r'\$\s*([\d,]+\.?\d*)'), '$'),
+    (re.compile(r'€\s*([\d,]+\.?\d*)'), '€'),
+    (re.compile(r'GBP\s*([\d,]+\.?\d*)'), '£'),
+    (re.compile(r'USD\s*([\d,]+\.?\d*)'), '$'),
+]
+
+def find_part_number(page_text):
+    """Return (part_number, rule pattern) for the highest-priority match, or (None, None)"""
+    lowered = page_text.lower()
+    if len(lowered) == len(page_text):
+        # Match on the lowercased text, but take the value from the original
+        for rule in PART_NUMBER_RULES:
+            for match in rule.finditer(lowered):
+                start, end = match.span(1)
+                if 3 <= end - start <= 20:  # Reasonable length
+                    return page_text[start:end], rule.pattern
+    else:
+        # Lowercasing changed offsets (rare non-ASCII case folds), match case-insensitively
+        for rule in PART_NUMBER_RULES:
+            for match in re.finditer(rule.pattern, page_text, re.IGNORECASE):
+                if 3 <= len(match.group(1)) <= 20:
+                    return match.group(1), rule.pattern
+    
+    # If no labelled part number is found, use the first likely candidate
+    match = PART_NUMBER_FALLBACK.search(page_text)
+    if match:
+        return match.group(0), PART_NUMBER_FALLBACK.pattern
+    return None, None
+
+def find_price(page_text):
+    """Return (price with currency symbol, rule pattern) for the highest-priority match, or (None, None)"""
+    for rule, currency in PRICE_RULES:
+        for match in rule.finditer(page_text):
+            amount = match.group(1)
+            try:
+                price_float = float(amount.replace(',', ''))
+            except ValueError:
+                continue
+            if 1 <= price_float <= 10000:  # Reasonable range
+                return f"{currency}{amount}", rule.pattern
+    return None, None
+
+# Structured data extraction. Most stores embed a JSON-LD Product block, microdata
+# or OpenGraph product tags; reading these with targeted regex scans of the raw HTML
+# is far cheaper than building the soup and running the full-text heuristics.
+LD_JSON_RE = re.compile(r'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.IGNORECASE | re.DOTALL)
+META_TAG_RE = re.compile(r'<(?:meta|link)\s[^>]*>', re.IGNORECASE)
+TAG_ATTR_RE = re.compile(r'([a-zA-Z:\-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+SHOPIFY_PRODUCT_PATH_RE = re.compile(r'^(.*/products/[^/?#.]+)/?$')
+SHOPIFY_CURRENCY_RE = re.compile(rb'Shopify\.currency\s*=\s*\{[^}]*"active"\s*:\s*"([A-Za-z]{3})"')
+
+# Bump when extraction logic changes so cached extraction results are re-parsed
+EXTRACTOR_VERSION = 1
+
+# Fields a structured record must have before the heuristic fallback can be skipped
+STRUCTURED_REQUIRED_FIELDS = ('title', 'price', 'description')
+
+CURRENCY_SYMBOLS = {'GBP': '£', 'USD': '$', 'EUR': '€'}
+# Assumed for bare amounts, matching the heuristic price rules which look for £ first
+DEFAULT_CURRENCY = 'GBP'
+
+AVAILABILITY_LABELS = {
+    'instock': 'In Stock',
+    'in stock': 'In Stock',
+    'onlineonly': 'In Stock',
+    'limitedavailability': 'Limited Availability',
+    'outofstock': 'Out of Stock',
+    'out of stock': 'Out of Stock',
+    'soldout': 'Out of Stock',
+    'discontinued': 'Discontinued',
+    'preorder': 'Pre-Order',
+    'backorder': 'Backorder',
+}
+
+def clean_text(value):
+    """Unescape entities, strip tags and collapse whitespace in a structured-data string"""
+    if value is None:
+        return None
+    text = html.unescape(HTML_TAG_RE.sub(' ', str(value)))
+    text = ' '.join(text.split())
+    return text or None
+
+def format_price(amount, currency=None):
+    """Format an amount the way the heuristic price rules do, e.g. '£189.99'"""
+    if amount in (None, ''):
+        return None
+    amount = str(amount).strip()
+    try:
+        float(amount.replace(',', ''))
+    except ValueError:
+        return None
+    currency = (currency or '').strip().upper()
+    if currency in CURRENCY_SYMBOLS:
+        return f"{CURRENCY_SYMBOLS[currency]}{amount}"
+    return f"{currency} {amount}" if currency else amount
+
+def availability_label(value):
+    """Map schema.org / OpenGraph availability values to a display label"""
+    if not value:
+        return None
+    key = str(value).rstrip('/').rsplit('/', 1)[-1].strip().lower()
+    return AVAILABILITY_LABELS.get(key, clean_text(value))
+
+def _first(value):
+    return value[0] if isinstance(value, list) and value else value
+
+def _image_urls(value):
+    urls = []
+    for image in value if isinstance(value, list) else [value]:
+        if isinstance(image, dict):
+            image = image.get('url') or image.get('contentUrl') or image.get('src')
+        if isinstance(image, str) and image.strip() and image.strip() not in urls:
+            urls.append(image.strip())
+    return urls
+
+def _set_images(product, urls):
+    if urls and 'image_url' not in product:
+        product['image_url'] = urls[0]
+        if len(urls) > 1:
+            product['additional_images'] = ','.join(urls[1:])
+
+def _iter_ld_products(node):
+    """Yield every schema.org Product object in a parsed JSON-LD document"""
+    if isinstance(node, list):
+        for item in node:
+            yield from _iter_ld_products(item)
+    elif isinstance(node, dict):
+        types = node.get('@type')
+        types = types if isinstance(types, list) else [types]
+        if 'Product' in types or 'ProductGroup' in types:
+            yield node
+        for key in ('@graph', 'mainEntity', 'itemListElement'):
+            if key in node:
+                yield from _iter_ld_products(node[key])
+
+def _product_from_ld(node):
+    product = {}
+    if node.get('name'):
+        product['title'] = clean_text(node['name'])
+    if node.get('description'):
+        product['description'] = clean_text(node['description'])
+    
+    part_number = node.get('mpn') or node.get('sku')
+    if part_number:
+        product['part_number'] = clean_text(part_number)
+    for key in ('gtin13', 'gtin', 'gtin12', 'gtin14', 'gtin8', 'ean'):
+        if node.get(key):
+            product['ean'] = clean_text(node[key])
+            break
+    
+    brand = _first(node.get('brand'))
+    if isinstance(brand, dict):
+        brand = brand.get('name')
+    if brand:
+        product['brand'] = clean_text(brand)
+    if node.get('color'):
+        product['color'] = clean_text(_first(node['color']))
+    condition = node.get('itemCondition')
+    
+    _set_images(product, _image_urls(node.get('image') or []))
+    
+    offer = _first(node.get('offers'))
+    if isinstance(offer, dict):
+        if isinstance(offer.get('offers'), list) and offer['offers']:
+            offer = offer['offers'][0]  # AggregateOffer wrapping individual offers
+        price = offer.get('price', offer.get('lowPrice'))
+        spec = offer.get('priceSpecification')
+        if price is None and isinstance(_first(spec), dict):
+            price = _first(spec).get('price')
+        price = format_price(price, offer.get('priceCurrency'))
+        if price:
+            product['price'] = price
+        if offer.get('availability'):
+            product['availability'] = availability_label(offer['availability'])
+        condition = condition or offer.get('itemCondition')
+        if 'part_number' not in product and offer.get('sku'):
+            product['part_number'] = clean_text(offer['sku'])
+    
+    if condition:
+        product['condition'] = str(condition).rstrip('/').rsplit('/', 1)[-1].replace('Condition', '')
+    return product
+
+def extract_structured_data(html_text):
+    """Read JSON-LD, microdata and OpenGraph product data from raw HTML.
+    
+    Sources are merged in that order of precedence; later sources only fill
+    fields the earlier ones didn't provide.
+    """
+    product = {}
+    
+    # JSON-LD Product blocks
+    for block in LD_JSON_RE.findall(html_text):
+        try:
+            document = json.loads(block.strip(), strict=False)
+        except ValueError:
+            continue
+        for node in _iter_ld_products(document):
+            for key, value in _product_from_ld(node).items():
+                if value and key not in product:
+                    product[key] = value
+    
+    # Microdata and OpenGraph tags, read from <meta>/<link> attributes only
+    itemprops = {}
+    properties = {}
+    og_images = []
+    for tag in META_TAG_RE.findall(html_text):
+        attrs = {}
+        for name, double_quoted, single_quoted in TAG_ATTR_RE.findall(tag):
+            attrs[name.lower()] = double_quoted or single_quoted
+        value = attrs.get('content') or attrs.get('href')
+        if not value:
+            continue
+        if attrs.get('itemprop'):
+            itemprops.setdefault(attrs['itemprop'], value)
+        key = attrs.get('property') or attrs.get('name')
+        if key:
+            key = key.lower()
+            if key in ('og:image', 'og:image:secure_url'):
+                og_images.append(value)
+            properties.setdefault(key, value)
+    
+    microdata = {
+        'title': clean_text(itemprops.get('name')),
+        'price': format_price(itemprops.get('price') or itemprops.get('lowPrice'), itemprops.get('priceCurrency')),
+        'part_number': clean_text(itemprops.get('mpn') or itemprops.get('sku')),
+        'ean': clean_text(itemprops.get('gtin13') or itemprops.get('gtin') or itemprops.get('gtin12')),
+        'brand': clean_text(itemprops.get('brand')),
+        'availability': availability_label(itemprops.get('availability')),
+    }
+    
+    is_product_page = properties.get('og:type', '').startswith('product') or 'product:price:amount' in properties
+    opengraph = {}
+    if is_product_page:
+        opengraph = {
+            'title': clean_text(properties.get('og:title')),
+            'description': clean_text(properties.get('og:description')),
+            'price': format_price(
+                properties.get('product:price:amount') or properties.get('og:price:amount'),
+                properties.get('product:price:currency') or properties.get('og:price:currency')
+            ),
+            'part_number': clean_text(properties.get('product:retailer_item_id')),
+            'brand': clean_text(properties.get('product:brand')),
+            'availability': availability_label(properties.get('product:availability') or properties.get('og:availability')),
+        }
+    
+    for source in (microdata, opengraph):
+        for key, value in source.items():
+            if value and key not in product:
+                product[key] = value
+    _set_images(product, _image_urls(itemprops.get('image') or []) or (og_images if is_product_page else []))
+    
+    return product
+
+KNOWN_BRANDS = ['plantronics', 'poly', 'epos', 'sennheiser', 'jabra', 'logitech', 'project telecom', 'cisco', 'yealink']
+
+def brand_from_title(title):
+    """Return the first known brand mentioned in a product title"""
+    title_lower = title.lower()
+    for brand in KNOWN_BRANDS:
+        if brand in title_lower:
+            return brand.title()
+    return None
+
+# Page regions that change between otherwise identical fetches (tracking scripts,
+# nonces, CSRF tokens in hidden inputs and <meta name="csrf-token"> style tags,
+# comments) are dropped before fingerprinting. JSON-LD blocks are kept since they
+# carry the price.
+FINGERPRINT_STRIP_RE = re.compile(
+    rb'<(?:script(?![^>]*application/ld\+json)[^>]*>.*?</script|style[^>]*>.*?</style|!--.*?--'
+    rb'|input[^>]*type=["\']hidden["\'][^>]*'
+    rb'|meta[^>]*(?:name|property)=["\'][^"\']*(?:csrf|xsrf|token|nonce)[^"\']*["\'][^>]*)>',
+    re.DOTALL | re.IGNORECASE
+)
+
+def content_fingerprint(content):
+    """Hash of the normalized page HTML, used to skip re-extracting unchanged pages"""
+    normalized = b' '.join(FINGERPRINT_STRIP_RE.sub(b'', content).split())
+    return hashlib.sha256(normalized).hexdigest()
+
+CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:\-]+)', re.IGNORECASE)
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w.:\-]+)', re.IGNORECASE)
+
+# Closing tags after which a partly read page may hold complete structured data
+EARLY_STOP_MARKERS = (b'</head>', b'</script>')
+EARLY_STOP_MAX_CHECKS = 8
+
+def page_encoding(content, content_type=None):
+    """Charset from the Content-Type header or a <meta> tag near the top of the
+    page, defaulting to UTF-8. Much cheaper than statistical detection."""
+    match = CHARSET_RE.search(content_type or '')
+    name = match.group(1) if match else None
+    if not name:
+        match = META_CHARSET_RE.search(content[:4096])
+        name = match.group(1).decode('ascii', errors='ignore') if match else None
+    try:
+        encoding = codecs.lookup(name or 'utf-8').name
+    except LookupError:
+        return 'utf-8'
+    # Browsers read Latin-1 labels as Windows-1252, and so do most pages that use them
+    return 'cp1252' if encoding == 'iso8859-1' else encoding
+
+def is_complete_record(product):
+    """True when structured data alone is enough to skip the heuristic extraction"""
+    return all(product.get(field) for field in STRUCTURED_REQUIRED_FIELDS)
+
+def shopify_product_json_url(url):
+    """Return the /products/<handle>.json URL for a Shopify product page, or None"""
+    parsed = urlparse(url)
+    match = SHOPIFY_PRODUCT_PATH_RE.match(parsed.path)
+    if not match:
+        return None
+    return parsed._replace(path=match.group(1) + '.json', query='', fragment='').geturl()
+
+def product_from_shopify_json(data, url, shop_currency=None):
+    """Map a Shopify /products/<handle>.json document to product data.
+    
+    The price is in the variant's presentment currency when the document gives
+    one, otherwise in `shop_currency` (or DEFAULT_CURRENCY when that's unknown).
+    """
+    item = data.get('product') if isinstance(data, dict) else None
+    if not isinstance(item, dict):
+        return None
+    
+    # Use the variant selected in the URL, otherwise the first one
+    variants = item.get('variants') or [{}]
+    variant_id = dict(p.split('=', 1) for p in urlparse(url).query.split('&') if '=' in p).get('variant')
+    variant = next((v for v in variants if str(v.get('id')) == variant_id), variants[0])
+    
+    currency = shop_currency or DEFAULT_CURRENCY
+    for presentment in variant.get('presentment_prices') or []:
+        if str(presentment.get('price', {}).get('amount')) == str(variant.get('price')):
+            currency = presentment['price'].get('currency_code') or currency
+            break
+    
+    product = {
+        'source_url': url,
+        'title': clean_text(item.get('title')),
+        'description': clean_text(item.get('body_html')),
+        'brand': clean_text(item.get('vendor')),
+        'part_number': clean_text(variant.get('sku')),
+        'ean': clean_text(variant.get('barcode')),
+        'price': format_price(variant.get('price'), currency),
+    }
+    if 'available' in variant:
+        product['availability'] = 'In Stock' if variant['available'] else 'Out of Stock'
+    _set_images(product, _image_urls(item.get('images') or []))
+    return {key: value for key, value in product.items() if value}
+
+# Product URL discovery
+SITEMAP_MAX_DEPTH = 3
+SITEMAP_PIECE_SIZE = 65536
+SHOPIFY_PRODUCTS_PAGE_SIZE = 250
+PRODUCT_URL_RE = re.compile(r'/products?/[^/?#]+/?$')
+ROBOTS_SITEMAP_RE = re.compile(r'^\s*sitemap\s*:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+
+def site_root(start):
+    """Normalise a domain or URL given for a discovery job to https://host/"""
+    start = start.strip()
+    if '://' not in start:
+        start = 'https://' + start
+    parsed = urlparse(start)
+    return f"{parsed.scheme}://{parsed.netloc.lower()}/"
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def iter_sitemap(chunks):
+    """Incrementally parse a sitemap or sitemap index from an iterable of byte chunks.
+    
+    Yields ('sitemap', loc) for entries of a sitemap index and ('url', loc) for
+    entries of a URL set. Gzipped sitemaps are decompressed on the fly, and each
+    entry is discarded once read, so memory stays flat however many URLs the
+    sitemap lists.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    
+    def pieces():
+        # Decompress in bounded pieces: a gzip chunk can expand many times over
+        decompressor = None
+        first = True
+        for chunk in chunks:
+            if first and chunk:
+                first = False
+                if chunk[:2] == b'\x1f\x8b':
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if decompressor is None:
+                yield chunk
+                continue
+            while chunk:
+                yield decompressor.decompress(chunk, SITEMAP_PIECE_SIZE)
+                chunk = decompressor.unconsumed_tail
+    
+    for piece in pieces():
+        parser.feed(piece)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            
+            name = _local_name(elem.tag)
+            if name in ('sitemap', 'url'):
+                for child in elem:
+                    if _local_name(child.tag) == 'loc' and child.text:
+                        yield name, child.text.strip()
+                        break
+                # Drop the finished entry so the tree never grows
+                root.clear()
+    parser.close()
+
+# Share of the size cap an over-full HTTP cache is evicted down to
+CACHE_EVICT_RATIO = 0.9
+
+class HttpCache:
+    """On-disk HTTP cache for re-scrapes, with size-based LRU eviction.
+    
+    Each URL gets a body file plus a JSON metadata file holding the ETag and
+    Last-Modified validators and, once the page has been parsed, the extraction
+    result. Later fetches send If-None-Match / If-Modified-Since, and a 304
+    reuses the stored result without downloading or parsing the page again.
+    
+    The directory may be shared by several processes (gunicorn workers and
+    worker.py), so recency is kept in the metadata files' mtimes and, once this
+    process's running total passes `max_bytes`, the directory is rescanned and
+    evicted against its real size, down to CACHE_EVICT_RATIO of the cap so the
+    next rescan isn't due straight away.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size on disk, least recently used first
+        self.total_bytes = 0
+        
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+    
+    def _scan(self):
+        """Rebuild the LRU order and total size from what's on disk"""
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                key = entry.name[:-len('.json')]
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                found.append((mtime, key, self._size_on_disk(key)))
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(found))
+        self.total_bytes = sum(self.entries.values())
+    
+    def _key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+    
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+    
+    def _size_on_disk(self, key):
+        size = 0
+        for suffix in ('.json', '.body'):
+            try:
+                size += os.path.getsize(self._path(key, suffix))
+            except OSError:
+                pass
+        return size
+    
+    def _write(self, path, data):
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    def _read_meta(self, key):
+        try:
+            with open(self._path(key, '.json'), 'rb') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+    
+    def _touch(self, key, size):
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            evict = []
+            if self.total_bytes > self.max_bytes:
+                # Other processes may have added or evicted entries since the last scan
+                self._scan()
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                while self.total_bytes > self.max_bytes * CACHE_EVICT_RATIO and len(self.entries) > 1:
+                    old_key, old_size = self.entries.popitem(last=False)
+                    self.total_bytes -= old_size
+                    evict.append(old_key)
+        for old_key in evict:
+            for suffix in ('.json', '.body'):
+                try:
+                    os.remove(self._path(old_key, suffix))
+                except OSError:
+                    pass
+    
+    def lookup(self, url):
+        """Return the cached metadata for a URL, or None"""
+        key = self._key(url)
+        # Entries stored by other processes aren't in self.entries yet
+        meta = self._read_meta(key)
+        if meta is None or meta.get('url') != url:
+            return None
+        try:
+            os.utime(self._path(key, '.json'))
+        except OSError:
+            pass
+        self._touch(key, self.entries.get(key) or self._size_on_disk(key))
+        return meta
+    
+    def read_body(self, url):
+        """Return the cached body for a URL, or None"""
+        try:
+            with open(self._path(self._key(url), '.body'), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def store(self, url, content, etag=None, last_modified=None):
+        """Cache a freshly downloaded page and its validators"""
+        key = self._key(url)
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': datetime.utcnow().isoformat(),
+            'product': None,
+        }
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        self._write(self._path(key, '.body'), content)
+        self._write(self._path(key, '.json'), meta_bytes)
+        self._touch(key, len(content) + len(meta_bytes))
+    
+    def store_product(self, url, product_data):
+        """Attach an extraction result to a cached page so a 304 can reuse it"""
+        key = self._key(url)
+        meta = self._read_meta(key)
+        if meta is None or meta.get('url') != url:
+            return
+        meta['product'] = product_data
+        meta['extractor_version'] = EXTRACTOR_VERSION
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        self._write(self._path(key, '.json'), meta_bytes)
+        self._touch(key, self._size_on_disk(key))
+
+# Query parameters that only track where a visitor came from
+TRACKING_PARAM_RE = re.compile(r'^(utm_|fbclid$|gclid$|mc_)', re.IGNORECASE)
+
+def normalize_url(url):
+    """Result cache key: lowercase scheme and host, no default port, fragment or
+    tracking parameters, and the rest of the query sorted"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    query = urlencode(sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not TRACKING_PARAM_RE.match(name)
+    ))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+class ResultCache:
+    """Recent extraction results shared by every job in the process, keyed by normalized URL.
+    
+    Results stay fresh for `ttl` seconds, and the least recently used are
+    evicted past `max_entries`. claim() also coalesces concurrent scrapes of a
+    URL: the first caller leads and fetches it, and everyone else gets a Future
+    that the leader's resolve() completes with the result (None if it failed).
+    """
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires at, product_data)
+        self.inflight = {}  # key -> (owner, Future)
+    
+    def claim(self, url, owner):
+        """Return ('hit', product_data), ('wait', Future) or ('lead', None).
+        
+        A leader must resolve() the URL once it has a result, or abandon() its claims.
+        """
+        key = normalize_url(url)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                result = ('hit', dict(entry[1]))
+            else:
+                if entry:
+                    del self.entries[key]
+                if key in self.inflight:
+                    result = ('wait', self.inflight[key][1])
+                else:
+                    self.inflight[key] = (owner, Future())
+                    result = ('lead', None)
+        
+        metrics.inc('scraper_result_cache_total', result={'wait': 'coalesced', 'lead': 'miss'}.get(result[0], 'hit'))
+        return result
+    
+    def resolve(self, url, product_data):
+        """Store a leader's result and hand it to the scrapes waiting on it"""
+        key = normalize_url(url)
+        with self.lock:
+            if product_data is not None:
+                self.entries[key] = (time.monotonic() + self.ttl, dict(product_data))
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            claimed = self.inflight.pop(key, None)
+        
+        # Waiters' callbacks run here, so only after the lock is released
+        if claimed:
+            claimed[1].set_result(dict(product_data) if product_data is not None else None)
+    
+    def abandon(self, owner):
+        """Release an owner's unresolved claims; their waiters fetch the URLs themselves"""
+        with self.lock:
+            keys = [key for key, (claimed_by, _) in self.inflight.items() if claimed_by is owner]
+            futures = [self.inflight.pop(key)[1] for key in keys]
+        for future in futures:
+            future.set_result(None)
+
+# More realistic browser headers to avoid blocking
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+    'Accept-Language': 'en-GB,en;q=0.9,en-US;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Cache-Control': 'max-age=0'
+}
+
+class Http2Response:
+    """The parts of requests.Response the scraper uses, over an httpx response.
+    
+    Streamed responses are read lazily: iter_content() pulls the body off the
+    connection chunk by chunk, and content, text and json() read what's left.
+    """
+    
+    def __init__(self, response, session):
+        self.response = response
+        self.session = session
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.encoding = response.encoding
+    
+    @property
+    def content(self):
+        with self.session.requests_errors():
+            return self.response.read()
+    
+    @property
+    def text(self):
+        self.content
+        return self.response.text
+    
+    def iter_content(self, chunk_size=65536):
+        with self.session.requests_errors():
+            yield from self.response.iter_bytes(chunk_size)
+    
+    def json(self):
+        self.content
+        return self.response.json()
+    
+    def close(self):
+        self.response.close()
+    
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+class Http2Session:
+    """requests.Session stand-in backed by an httpx client with HTTP/2 enabled.
+    
+    Hosts that support HTTP/2 get one multiplexed connection shared by every
+    job; others fall back to pooled HTTP/1.1 keep-alive connections.
+    Transport errors are raised as requests exceptions so callers handle both
+    clients the same way.
+    """
+    def __init__(self, max_connections=100, max_keepalive=20):
+        import httpx
+        self.httpx = httpx
+        # Connection-specific headers aren't allowed over HTTP/2
+        headers = {name: value for name, value in BROWSER_HEADERS.items() if name != 'Connection'}
+        self.client = httpx.Client(
+            http2=True,
+            headers=headers,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        )
+    
+    @contextlib.contextmanager
+    def requests_errors(self):
+        """Re-raise httpx transport errors as the matching requests exceptions"""
+        try:
+            yield
+        except self.httpx.TimeoutException as e:
+            raise requests.Timeout(str(e))
+        except self.httpx.HTTPError as e:
+            raise requests.ConnectionError(str(e))
+    
+    def get(self, url, headers=None, timeout=20, allow_redirects=True, stream=False):
+        request = self.client.build_request('GET', url, headers=headers, timeout=timeout)
+        with self.requests_errors():
+            response = self.client.send(request, stream=stream, follow_redirects=allow_redirects)
+        return Http2Response(response, self)
+
+def build_http_session(pool_hosts=10, pool_per_host=10, http2=False):
+    """HTTP client with keep-alive connection pools for up to `pool_hosts` hosts
+    of `pool_per_host` connections each.
+    
+    With http2, uses httpx when it's installed with HTTP/2 support
+    (pip install httpx[http2]) and otherwise falls back to requests.
+    """
+    if http2:
+        try:
+            import h2  # noqa: F401
+            return Http2Session(max_connections=pool_hosts * pool_per_host, max_keepalive=pool_hosts * pool_per_host)
+        except ImportError:
+            logger.warning("HTTP/2 needs httpx[http2] installed, using HTTP/1.1 connection pools")
+    
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(BROWSER_HEADERS)
+    return session
+
+# Marks the end of a streamed URL source in scrape_many's output queue
+SOURCE_DONE = object()
+
+class UniversalProductScraper:
+    def __init__(
+        self,
+        delay=3,
+        concurrency=8,
+        jitter=2,
+        extract_pool=None,
+        parser='html.parser',
+        http_cache=None,
+        buffer_size=None,
+        session=None,
+        max_rate=5,
+        max_retries=3,
+        retry_base_delay=2,
+        trace_sample=0.0,
+        trace_hosts=(),
+        result_cache=None,
+        max_page_bytes=5 * 1024 * 1024,
+        early_stop=False,
+        scheduler=None,
+        weight=1
+    ):
+        self.delay = delay
+        self.http_cache = http_cache
+        self.parser = resolve_parser(parser)
+        self.concurrency = max(1, concurrency)
+        self.buffer_size = max(1, buffer_size or self.concurrency * 4)
+        self.extract_pool = extract_pool
+        self.stats = PipelineStats()
+        self.timings = JobTimings()
+        self.tracer = ExtractionTracer(sample=trace_sample, hosts=trace_hosts)
+        self.result_cache = result_cache
+        self.max_page_bytes = max_page_bytes
+        self.early_stop = early_stop
+        self.shopify_hosts = {}  # host -> whether /products/<handle>.json can be used
+        self.shop_currencies = {}  # Shopify host -> store currency read from its pages
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.outcomes = {}  # url -> attempts and failure details, see scrape_many
+        self.scheduler = scheduler
+        self.weight = weight
+        if scheduler is not None:
+            self.rate_limiter = scheduler.rate_limiter
+        else:
+            self.rate_limiter = HostRateLimiter(delay=delay, jitter=jitter, max_rate=max_rate)
+        self.session = session or build_http_session(pool_per_host=self.concurrency)
+    
+    def scrape_many(self, urls, known_fingerprints=None):
+        """Scrape URLs concurrently, yielding (url, product_data) as each one finishes.
+        
+        Runs as a three-stage pipeline: fetch threads download pages, the
+        extraction pool (or the fetch thread, without one) parses them, and the
+        caller persists each yielded result. Stage activity is tracked in
+        `self.stats`.
+        
+        At most `concurrency` requests run at once across the whole job, and each
+        host gets its own token bucket so the politeness delay only throttles
+        requests to the same domain. Only one request per host is in flight at a time.
+        
+        No more than `buffer_size` URLs are between dispatch and the caller at
+        once, so when parsing or the caller's database writes fall behind, new
+        fetches wait rather than pages piling up in memory.
+        
+        `known_fingerprints` maps URLs to the content hash from a previous scrape;
+        pages whose fingerprint still matches skip extraction and are yielded as
+        {'source_url': url, 'content_hash': ..., 'unchanged': True}.
+        
+        Transient fetch failures are put back in the queue with jittered
+        exponential backoff, up to `max_retries` times, without holding up other
+        URLs. URLs that fail for good are yielded with product_data None, and
+        for those and any URL that needed retries, `self.outcomes[url]` holds
+        {'attempts', 'failure_kind', 'error'} until the caller pops it.
+        
+        `urls` can also be an iterator that produces URLs as it finds them (see
+        discover_product_urls). It's read on its own thread a few buffers ahead
+        of the fetchers, so URLs are scraped while discovery carries on.
+        
+        With a `scheduler`, each fetch also needs one of its slots, which are
+        shared with other jobs in proportion to `weight`.
+        
+        With a `result_cache`, URLs scraped recently by any job are answered from
+        it, and a URL another job (or an earlier copy in this list) is already
+        fetching waits for that result instead of being fetched again.
+        """
+        known_fingerprints = known_fingerprints or {}
+        stats = self.stats
+        output = queue.Queue()  # finished (url, product_data), holds at most buffer_size
+        control = queue.Queue()  # ('fetched'|'retry'|'coalesced'|'consumed'|'source'|'wake', ...) for the dispatcher
+        stopped = threading.Event()
+        streamed = not isinstance(urls, (list, tuple))
+        incoming = queue.Queue(maxsize=self.buffer_size * 4)
+        
+        run = object()  # owner of this run's result cache claims
+        share = None
+        if self.scheduler is not None:
+            share = self.scheduler.register(self.weight, lambda: control.put(('wake', None)))
+        
+        def finish(url, product_data, stage):
+            if self.result_cache is not None:
+                complete = product_data is not None and not product_data.get('unchanged')
+                self.result_cache.resolve(url, product_data if complete else None)
+            stats.leave(stage)
+            stats.enter('persist')
+            output.put((url, product_data))
+        
+        def deliver(url, product_data):
+            # A result scraped by another job or another copy of the URL
+            fingerprint = product_data.get('content_hash')
+            if fingerprint and known_fingerprints.get(url) == fingerprint:
+                product_data = {'source_url': url, 'content_hash': fingerprint, 'unchanged': True}
+            else:
+                product_data = dict(product_data, source_url=url)
+            stats.enter('persist')
+            output.put((url, product_data))
+        
+        def coalesced(url, future):
+            control.put(('coalesced', (url, future.result())))
+        
+        def failed(url, attempt, error, stage):
+            failure_kind, reason = classify_failure(error)
+            logger.error(f"Error scraping {url} ({failure_kind}): {reason}")
+            if failure_kind == 'transient' and attempt < self.max_retries:
+                delay = retry_delay(attempt, self.retry_base_delay)
+                logger.info(f"Retrying {url} in {delay:.1f}s")
+                stats.leave(stage)
+                control.put(('retry', (url, attempt + 1, time.monotonic() + delay)))
+                return False
+            self.outcomes[url] = {'attempts': attempt + 1, 'failure_kind': failure_kind, 'error': reason}
+            finish(url, None, stage)
+            return True
+        
+        def extracted(url, attempt, fingerprint, pool, future):
+            try:
+                product_data, timings = future.result()
+                self.timings.record_all(timings)
+                product_data['content_hash'] = fingerprint
+                self.cache_product(url, product_data)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self.extract_pool = replace_extract_pool(pool)
+                failed(url, attempt, e, 'parse')
+                return
+            finish(url, product_data, 'parse')
+        
+        def fetch(host, url, attempt):
+            if attempt:
+                self.outcomes[url] = {'attempts': attempt + 1, 'failure_kind': None, 'error': None}
+            try:
+                content, product_data = self.fetch_product_page(url)
+            except Exception as e:
+                # Any retry is queued before the dispatcher hears the fetch is done
+                failed(url, attempt, e, 'fetch')
+                control.put(('fetched', host))
+                return
+            control.put(('fetched', host))
+            stats.leave('fetch')
+            stats.enter('parse')
+            
+            if content is not None:
+                fingerprint = content_fingerprint(content)
+            else:
+                fingerprint = product_data.get('content_hash') if product_data else None
+            
+            if fingerprint and known_fingerprints.get(url) == fingerprint:
+                logger.info(f"Unchanged since last scrape: {url}")
+                finish(url, {'source_url': url, 'content_hash': fingerprint, 'unchanged': True}, 'parse')
+                return
+            
+            if content is None:
+                finish(url, product_data, 'parse')
+                return
+            
+            pool = self.extract_pool
+            if pool is not None:
+                try:
+                    future = pool.submit(extract_page, content, url)
+                    future.add_done_callback(lambda f: extracted(url, attempt, fingerprint, pool, f))
+                    return
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        self.extract_pool = replace_extract_pool(pool)
+                    logger.error(f"Extraction pool unavailable, parsing inline: {str(e)}")
+            
+            try:
+                timings = {}
+                product_data = self.parse_page(content, url, timings)
+                self.timings.record_all(timings)
+                product_data['content_hash'] = fingerprint
+                self.cache_product(url, product_data)
+            except Exception as e:
+                failed(url, attempt, e, 'parse')
+                return
+            finish(url, product_data, 'parse')
+        
+        sequence = itertools.count()
+        
+        def dispatch(executor):
+            try:
+                schedule(executor)
+            except Exception as e:
+                logger.error(f"Error dispatching fetches: {str(e)}")
+                output.put(None)
+        
+        def feed():
+            # Read a streamed URL source ahead of the dispatcher; blocks while
+            # `incoming` is full so discovery never runs far ahead of scraping
+            try:
+                for url in urls:
+                    if not offer(url):
+                        return
+            except Exception as e:
+                logger.error(f"Error reading URLs: {str(e)}")
+            offer(None)
+        
+        def offer(url):
+            while not stopped.is_set():
+                try:
+                    incoming.put(url, timeout=0.5)
+                    control.put(('source', None))
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def schedule(executor):
+            pending = {}
+            source_done = not streamed
+            if not streamed:
+                for url in urls:
+                    pending.setdefault(url_host(url), deque()).append((url, 0))
+            total = 0
+            retries = []  # heap of (ready at, sequence, url, attempt)
+            busy_hosts = set()
+            in_flight = 0
+            buffered = 0  # dispatched but not yet taken by the caller
+            leading = set()  # URLs at the head of a host queue this run has claimed
+            coalescing = 0  # URLs waiting on another fetch of the same URL
+            
+            def reuse(url):
+                # Serve a URL from the result cache or another fetch of it; False
+                # means this run leads and fetches it
+                nonlocal coalescing
+                if url in leading:
+                    return False
+                state, value = self.result_cache.claim(url, run)
+                if state == 'hit':
+                    deliver(url, value)
+                elif state == 'wait':
+                    coalescing += 1
+                    value.add_done_callback(lambda future: coalesced(url, future))
+                else:
+                    leading.add(url)
+                    return False
+                return True
+            
+            while (pending or retries or in_flight or coalescing or not source_done) and not stopped.is_set():
+                # Take in any URLs the source has produced
+                while not source_done:
+                    try:
+                        url = incoming.get_nowait()
+                    except queue.Empty:
+                        break
+                    if url is None:
+                        source_done = True
+                        output.put((SOURCE_DONE, total))
+                    else:
+                        total += 1
+                        pending.setdefault(url_host(url), deque()).append((url, 0))
+                
+                # Retries that are due go to the front of their host's queue
+                now = time.monotonic()
+                while retries and retries[0][0] <= now:
+                    _, _, url, attempt = heapq.heappop(retries)
+                    pending.setdefault(url_host(url), deque()).appendleft((url, attempt))
+                next_wait = retries[0][0] - now if retries else None
+                
+                # Dispatch every idle host whose bucket has a token, up to the job's,
+                # the scheduler's and the buffer limits
+                denied = False
+                for host in list(pending):
+                    # First-time URLs whose result is cached or on its way don't
+                    # need the host
+                    while self.result_cache is not None and buffered < self.buffer_size:
+                        url, attempt = pending[host][0]
+                        if attempt or not reuse(url):
+                            break
+                        buffered += 1
+                        pending[host].popleft()
+                        if not pending[host]:
+                            del pending[host]
+                            break
+                    if host not in pending:
+                        continue
+                    
+                    if in_flight >= self.concurrency or buffered >= self.buffer_size:
+                        break
+                    if host in busy_hosts:
+                        continue
+                    wait = self.rate_limiter.wait_time(host)
+                    if wait > 0:
+                        next_wait = wait if next_wait is None else min(next_wait, wait)
+                        continue
+                    if share is not None and not self.scheduler.try_acquire(share):
+                        denied = True
+                        break
+                    
+                    self.rate_limiter.consume(host)
+                    url, attempt = pending[host].popleft()
+                    if not pending[host]:
+                        del pending[host]
+                    leading.discard(url)
+                    busy_hosts.add(host)
+                    in_flight += 1
+                    buffered += 1
+                    stats.enter('fetch')
+                    executor.submit(fetch, host, url, attempt)
+                if share is not None and not denied:
+                    self.scheduler.idle(share)
+                
+                # Wait for a fetch to finish, the caller to take a result, or the
+                # next host or retry to become ready
+                try:
+                    kind, value = control.get(timeout=next_wait)
+                except queue.Empty:
+                    continue
+                
+                if kind == 'fetched':
+                    busy_hosts.discard(value)
+                    in_flight -= 1
+                    if share is not None:
+                        self.scheduler.release(share)
+                elif kind == 'retry':
+                    url, attempt, ready_at = value
+                    heapq.heappush(retries, (ready_at, next(sequence), url, attempt))
+                    buffered -= 1
+                elif kind == 'coalesced':
+                    coalescing -= 1
+                    url, product_data = value
+                    if product_data is not None:
+                        deliver(url, product_data)
+                    else:
+                        # The leader failed or had no full result; fetch it here instead
+                        heapq.heappush(retries, (time.monotonic(), next(sequence), url, 0))
+                        buffered -= 1
+                elif kind == 'consumed':
+                    buffered -= 1
+        
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            dispatcher = threading.Thread(target=dispatch, args=(executor,), daemon=True)
+            dispatcher.start()
+            if streamed:
+                threading.Thread(target=feed, daemon=True).start()
+            try:
+                total = None if streamed else len(urls)
+                finished = 0
+                while total is None or finished < total:
+                    result = output.get()
+                    if result is None:
+                        raise RuntimeError('Fetch dispatcher stopped unexpectedly')
+                    if result[0] is SOURCE_DONE:
+                        total = result[1]
+                        continue
+                    finished += 1
+                    yield result
+                    stats.leave('persist')
+                    control.put(('consumed', None))
+            finally:
+                stopped.set()
+                control.put(('consumed', None))
+                dispatcher.join()
+                if share is not None:
+                    self.scheduler.unregister(share)
+                if self.result_cache is not None:
+                    self.result_cache.abandon(run)
+    
+    def discover_product_urls(self, start, skip=()):
+        """Yield product URLs for a store, without repeats, as they're found.
+        
+        Shopify stores are listed through /products.json pagination. Other sites
+        are read from the sitemaps named in robots.txt (or /sitemap.xml),
+        following sitemap indexes; when an index has product sitemaps only those
+        are read. URLs in `skip` are left out, so a resumed discovery job doesn't
+        repeat URLs it has already scraped.
+        """
+        root = site_root(start)
+        host = url_host(root)
+        seen = set(skip)
+        
+        def new(url):
+            if url in seen:
+                return False
+            seen.add(url)
+            return True
+        
+        found = False
+        for url in self.discover_shopify_products(root):
+            found = True
+            if new(url):
+                yield url
+        if found:
+            return
+        
+        sitemaps = deque((url, 0) for url in self.robots_sitemaps(root) or [urljoin(root, 'sitemap.xml')])
+        visited = set()
+        dropped = listed = 0
+        while sitemaps:
+            sitemap_url, depth = sitemaps.popleft()
+            if sitemap_url in visited:
+                continue
+            visited.add(sitemap_url)
+            product_sitemap = 'product' in sitemap_url.lower()
+            
+            response = None
+            try:
+                self.wait_for_host(host)
+                response = self.http_get(sitemap_url, stream=True)
+                response.raise_for_status()
+                children = []
+                for kind, loc in iter_sitemap(response.iter_content(chunk_size=65536)):
+                    if kind == 'sitemap':
+                        children.append(loc)
+                    elif not product_sitemap and not PRODUCT_URL_RE.search(urlparse(loc).path):
+                        dropped += 1
+                    elif new(loc):
+                        listed += 1
+                        yield loc
+            except (requests.RequestException, ElementTree.ParseError, OSError) as e:
+                logger.error(f"Error reading sitemap {sitemap_url}: {str(e)}")
+                continue
+            finally:
+                # Also reached when the caller stops early, so the connection goes back to the pool
+                if response is not None:
+                    response.close()
+            
+            if depth < SITEMAP_MAX_DEPTH:
+                product_children = [loc for loc in children if 'product' in loc.lower()]
+                sitemaps.extend((loc, depth + 1) for loc in product_children or children)
+        
+        # Stores with flat product URLs (/some-product.html) don't match the pattern
+        if dropped:
+            log = logger.warning if not listed else logger.info
+            log(f"Skipped {dropped} sitemap URLs on {host} that don't look like product pages "
+                f"({PRODUCT_URL_RE.pattern}), found {listed}")
+    
+    def discover_shopify_products(self, root):
+        """Yield product page URLs from a Shopify store's /products.json pages"""
+        host = url_host(root)
+        page = 1
+        while True:
+            self.wait_for_host(host)
+            try:
+                response = self.http_get(urljoin(root, f"products.json?limit={SHOPIFY_PRODUCTS_PAGE_SIZE}&page={page}"))
+                response.raise_for_status()
+                products = response.json().get('products')
+            except (requests.RequestException, ValueError, AttributeError):
+                return
+            if not isinstance(products, list) or not products:
+                return
+            
+            # Product pages on this host can skip HTML and use the product JSON
+            self.shopify_hosts[host] = True
+            for product in products:
+                if isinstance(product, dict) and product.get('handle'):
+                    yield urljoin(root, f"products/{product['handle']}")
+            page += 1
+    
+    def robots_sitemaps(self, root):
+        """Sitemap URLs listed in robots.txt"""
+        try:
+            self.wait_for_host(url_host(root))
+            response = self.http_get(urljoin(root, 'robots.txt'))
+            response.raise_for_status()
+        except requests.RequestException:
+            return []
+        return ROBOTS_SITEMAP_RE.findall(response.text)
+    
+    def wait_for_host(self, host):
+        """Block until the host's rate limit allows another request, then take it"""
+        while True:
+            wait = self.rate_limiter.wait_time(host)
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        self.rate_limiter.consume(host)
+    
+    def http_get(self, url, headers=None, stream=False):
+        """GET a URL, reporting the response time and status to the host's rate controller.
+        
+        Also records the time to the response headers and the time spent
+        downloading the body (unless streaming) in `self.timings` and `metrics`.
+        """
+        host = url_host(url)
+        started = time.monotonic()
+        _request_context.timings = self.timings
+        try:
+            response = self.session.get(url, headers=headers, timeout=20, allow_redirects=True, stream=stream)
+        except (requests.Timeout, requests.ConnectionError):
+            self.rate_limiter.observe(host)
+            metrics.inc('scraper_request_errors_total', host=host)
+            raise
+        finally:
+            _request_context.timings = None
+        latency = time.monotonic() - started
+        
+        self.rate_limiter.observe(
+            host,
+            latency=latency,
+            status=response.status_code,
+            retry_after=response.headers.get('Retry-After')
+        )
+        metrics.inc('scraper_responses_total', host=host, status=response.status_code)
+        
+        # requests' elapsed stops at the headers, so the rest of the latency is the body
+        elapsed = getattr(response, 'elapsed', None)
+        if stream or elapsed is None:
+            self.timings.record('response', latency)
+        else:
+            elapsed = min(elapsed.total_seconds(), latency)
+            self.timings.record('response', elapsed)
+            self.timings.record('download', latency - elapsed)
+        if not stream:
+            metrics.inc('scraper_downloaded_bytes_total', len(response.content), host=host)
+        return response
+    
+    def fetch_product_page(self, url):
+        """Fetch a product URL, returning (content, product_data).
+        
+        product_data is returned instead of content when the product is available
+        without parsing HTML: from a Shopify store's product JSON, or from the
+        HTTP cache when the server reports the page unchanged.
+        """
+        product_data = self.fetch_shopify_product(url)
+        if product_data is not None:
+            return None, product_data
+        return self.fetch_page(url)
+    
+    def fetch_page(self, url):
+        """Download a product page, revalidating against the HTTP cache.
+        
+        Returns (content, cached_product); cached_product is set on a 304 when the
+        stored extraction result is still current.
+        """
+        logger.info(f"Universal scraping: {url}")
+        
+        headers = {}
+        cached = self.http_cache.lookup(url) if self.http_cache else None
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        
+        response = self.http_get(url, headers=headers, stream=True)
+        
+        if response.status_code == 304 and cached:
+            response.close()
+            if cached.get('product') and cached.get('extractor_version') == EXTRACTOR_VERSION:
+                logger.info(f"Not modified, reusing cached result: {url}")
+                metrics.inc('scraper_http_cache_total', result='hit')
+                return None, dict(cached['product'])
+            content = self.http_cache.read_body(url)
+            if content is not None:
+                logger.info(f"Not modified, re-parsing cached page: {url}")
+                metrics.inc('scraper_http_cache_total', result='revalidated')
+                return content, None
+            # Cached body went missing; fetch the page unconditionally
+            response = self.http_get(url, stream=True)
+        
+        if self.http_cache:
+            metrics.inc('scraper_http_cache_total', result='miss')
+        if response.status_code >= 400:
+            response.close()
+        response.raise_for_status()
+        
+        # Remember Shopify stores so later pages can use the product JSON endpoint
+        host = url_host(url)
+        if host not in self.shopify_hosts and (
+                'X-ShopId' in response.headers or response.headers.get('Powered-By') == 'Shopify'):
+            self.shopify_hosts[host] = True
+        
+        content = self.read_page(response, url)
+        if self.shopify_hosts.get(host) and host not in self.shop_currencies:
+            match = SHOPIFY_CURRENCY_RE.search(content)
+            if match:
+                self.shop_currencies[host] = match.group(1).decode('ascii').upper()
+        
+        # Pages are parsed as UTF-8, so transcode the few that declare another charset
+        encoding = page_encoding(content, response.headers.get('Content-Type'))
+        if encoding not in ('utf-8', 'ascii'):
+            content = content.decode(encoding, errors='replace').encode('utf-8')
+        
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if self.http_cache and (etag or last_modified):
+            self.http_cache.store(url, content, etag, last_modified)
+        return content, None
+    
+    def read_page(self, response, url):
+        """Read a streamed page body, stopping at `max_page_bytes`.
+        
+        With `early_stop`, also stops after a </head> or </script> once the
+        structured data read so far is a complete record, since parse_page won't
+        look at the rest. The body is then cut just after that tag so the page's
+        fingerprint doesn't depend on how the response was chunked.
+        """
+        started = time.monotonic()
+        body = bytearray()
+        checks = 0
+        try:
+            for chunk in response.iter_content(chunk_size=65536):
+                body += chunk
+                if len(body) >= self.max_page_bytes:
+                    del body[self.max_page_bytes:]
+                    logger.warning(f"Page over {self.max_page_bytes} bytes, truncated: {url}")
+                    break
+                
+                if not self.early_stop or checks >= EARLY_STOP_MAX_CHECKS:
+                    continue
+                # Only look again when this chunk closed a tag structured data can end with
+                search_from = max(0, len(body) - len(chunk) - 16)
+                end = max(body.rfind(marker, search_from) for marker in EARLY_STOP_MARKERS)
+                if end < 0:
+                    continue
+                checks += 1
+                end = body.index(b'>', end) + 1
+                if is_complete_record(extract_structured_data(body[:end].decode('utf-8', errors='replace'))):
+                    del body[end:]
+                    logger.info(f"Structured data complete after {end} bytes, stopped reading: {url}")
+                    break
+        finally:
+            response.close()
+        
+        self.timings.record('download', time.monotonic() - started)
+        metrics.inc('scraper_downloaded_bytes_total', len(body), host=url_host(url))
+        return bytes(body)
+    
+    def cache_product(self, url, product_data):
+        """Store an extraction result alongside its cached page"""
+        if self.http_cache and product_data:
+            self.http_cache.store_product(url, product_data)
+    
+    def fetch_shopify_product(self, url):
+        """Fetch product data from /products/<handle>.json on known Shopify stores.
+        
+        Returns None when the host isn't a known Shopify store or the endpoint
+        doesn't give a complete record, in which case the HTML page is used.
+        """
+        host = url_host(url)
+        json_url = shopify_product_json_url(url)
+        if not json_url or not self.shopify_hosts.get(host):
+            return None
+        
+        try:
+            response = self.http_get(json_url)
+            response.raise_for_status()
+            product = product_from_shopify_json(response.json(), url, self.shop_currencies.get(host))
+            if product:
+                product['content_hash'] = content_fingerprint(response.content)
+        except (requests.RequestException, ValueError) as e:
+            logger.info(f"Shopify product JSON unavailable for {host}: {str(e)}")
+            product = None
+        
+        if not product or not is_complete_record(product):
+            # Don't keep paying for the extra request on this host
+            self.shopify_hosts[host] = False
+            return None
+        
+        product.setdefault('availability', 'Available')
+        logger.info(f"Using Shopify product JSON for {url}")
+        return product
+    
+    def parse_page(self, content, url, timings=None):
+        """Parse a downloaded page and extract product data.
+        
+        Structured data (JSON-LD, microdata, OpenGraph) is read first with a cheap
+        scan of the raw HTML. The soup and full-text heuristics only run when it
+        doesn't give a complete record, and structured values win where both exist.
+        
+        Pass a `timings` dict to have the seconds spent in each step added to it.
+        Pages picked by `self.tracer` log how each field was found.
+        """
+        trace = self.tracer.start(url)
+        mark = time.perf_counter()
+        structured = extract_structured_data(content.decode('utf-8', errors='replace'))
+        mark = lap(timings, 'structured_data', mark)
+        if trace:
+            trace.add('structured_data', fields=sorted(structured), complete=is_complete_record(structured))
+        if is_complete_record(structured):
+            product = {'source_url': url}
+            product.update(structured)
+            if 'brand' not in product and brand_from_title(product['title']):
+                product['brand'] = brand_from_title(product['title'])
+            product.setdefault('availability', 'Available')
+            if trace:
+                trace.emit(product)
+            return product
+        
+        soup = BeautifulSoup(content, self.parser, from_encoding='utf-8')
+        lap(timings, 'html_parse', mark)
+        product = self.extract_product_data(soup, url, timings, trace)
+        product.update(structured)
+        if trace:
+            trace.emit(product)
+        return product
+    
+    def scrape_product(self, url):
+        """Universal product scraper with better encoding handling"""
+        try:
+            content, product_data = self.fetch_product_page(url)
+            if product_data is None:
+                product_data = self.parse_page(content, url)
+                product_data['content_hash'] = content_fingerprint(content)
+                self.cache_product(url, product_data)
+            return product_data
+        except Exception as e:
+            logger.error(f"Error scraping {url}: {str(e)}")
+            return None
+
+    def extract_product_data(self, soup, url, timings=None, trace=None):
+        """Fixed extraction with better encoding handling.
+        
+        With a `timings` dict, adds the seconds spent on each field under
+        'extract.<field>' and the total under 'extract'. With an ExtractionTrace,
+        records which rule or element each field came from.
+        """
+        started = mark = time.perf_counter()
+        product = {'source_url': url}
+        
+        # Get page text with better encoding handling
+        try:
+            page_text = soup.get_text(separator=' ', strip=True)
+        except:
+            page_text = str(soup.get_text())
+        
+        # Clean up encoding issues
+        page_text = page_text.encode('utf-8', errors='ignore').decode('utf-8')
+        
+        if trace:
+            trace.add('page_text', length=len(page_text), preview=page_text[:500])
+        mark = lap(timings, 'extract.page_text', mark)
+        
+        # TITLE EXTRACTION - Multiple methods
+        title = None
+        
+        # Method 1: Page title tag
+        title_tag = soup.find('title')
+        if title_tag:
+            title = title_tag.get_text(strip=True)
+            if trace:
+                trace.add('title', source='title tag', value=title)
+        
+        # Method 2: H1 tags
+        if not title:
+            h1_tags = soup.find_all('h1')
+            for h1 in h1_tags:
+                h1_text = h1.get_text(strip=True)
+                if h1_text and len(h1_text) > 5:
+                    title = h1_text
+                    if trace:
+                        trace.add('title', source='h1', value=title)
+                    break
+        
+        # Method 3: Product name selectors
+        if not title:
+            selectors = ['.product-name', '.product-title', '.entry-title', '[data-testid="product-title"]']
+            for selector in selectors:
+                element = soup.select_one(selector)
+                if element:
+                    title = element.get_text(strip=True)
+                    if trace:
+                        trace.add('title', source=selector, value=title)
+                    break
+        
+        if title:
+            # Clean up title
+            for suffix in [' - Best4Systems', ' | Best4Systems', ' - PMC Telecom', ' - Headset Store']:
+                title = re.sub(re.escape(suffix) + r'.*$', '', title, flags=re.IGNORECASE)
+            product['title'] = title.strip()
+        mark = lap(timings, 'extract.title', mark)
+        
+        # PART NUMBER EXTRACTION - Look for "part number: XXXXX" pattern first, then likely candidates
+        part_number, rule = find_part_number(page_text)
+        if part_number:
+            product['part_number'] = part_number
+            if trace:
+                trace.add('part_number', rule=rule, value=part_number)
+        mark = lap(timings, 'extract.part_number', mark)
+        
+        # BRAND EXTRACTION - check title for known brands
+        if 'title' in product:
+            brand = brand_from_title(product['title'])
+            if brand:
+                product['brand'] = brand
+                if trace:
+                    trace.add('brand', source='title', value=brand)
+        
+        # Brand-related lines only help diagnose pages without a known brand
+        if 'brand' not in product and trace:
+            brand_lines = [
+                line.strip() for line in page_text.split('\n')
+                if any(word in line.lower() for word in ['brand', 'manufacturer', 'made by'])
+            ]
+            trace.add('brand', source=None, candidate_lines=brand_lines[:3])
+        mark = lap(timings, 'extract.brand', mark)
+        
+        # PRICE EXTRACTION
+        price, rule = find_price(page_text)
+        if price:
+            product['price'] = price
+            if trace:
+                trace.add('price', rule=rule, value=price)
+        mark = lap(timings, 'extract.price', mark)
+        
+        # DESCRIPTION EXTRACTION
+        
+        # Look for description in meta tags
+        meta_desc = soup.find('meta', attrs={'name': 'description'})
+        if meta_desc and meta_desc.get('content'):
+            desc = meta_desc.get('content').strip()
+            if len(desc) > 20:
+                product['description'] = desc
+                if trace:
+                    trace.add('description', source='meta description')
+        
+        # Look for product descriptions in common containers
+        if 'description' not in product:
+            desc_selectors = [
+                '.product-description', '.description', '.product-details', 
+                '.product-info', '.entry-content', '[data-testid="description"]'
+            ]
+            
+            for selector in desc_selectors:
+                elements = soup.select(selector)
+                for element in elements:
+                    desc = element.get_text(strip=True)
+                    if 50 < len(desc) < 1000:
+                        product['description'] = desc[:500]  # Limit length
+                        if trace:
+                            trace.add('description', source=selector)
+                        break
+                if 'description' in product:
+                    break
+        
+        # Look for paragraph descriptions
+        if 'description' not in product:
+            paragraphs = soup.find_all('p')
+            for para in paragraphs:
+                desc = para.get_text(strip=True)
+                if (100 < len(desc) < 800 and 
+                    not any(word in desc.lower() for word in ['cookie', 'privacy', 'delivery', 'return'])):
+                    product['description'] = desc
+                    if trace:
+                        trace.add('description', source='paragraph')
+                    break
+        lap(timings, 'extract.description', mark)
+        
+        # Set defaults if nothing found
+        if 'title' not in product:
+            # Extract from URL as fallback
+            url_parts = url.split('/')
+            for part in reversed(url_parts):
+                if part and len(part) > 5 and '-' in part:
+                    title = part.replace('-', ' ').replace('.html', '').title()
+                    product['title'] = title
+                    if trace:
+                        trace.add('title', source='url', value=title)
+                    break
+            
+            if 'title' not in product:
+                product['title'] = f"Product from {url.split('//')[-1].split('/')[0]}"
+                if trace:
+                    trace.add('title', source='default')
+        
+        if 'description' not in product:
+            product['description'] = f"Professional {product.get('title', 'product')} with advanced features."
+            if trace:
+                trace.add('description', source='default')
+        
+        product['availability'] = 'Available'
+        lap(timings, 'extract', started)
+        
+        return product
+
+# Extraction worker processes
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+_extract_scraper = None
+
+def _init_extract_worker(parser, trace_sample, trace_hosts):
+    global _extract_scraper
+    _extract_scraper = UniversalProductScraper(parser=parser, trace_sample=trace_sample, trace_hosts=trace_hosts)
+
+def extract_page(content, url):
+    """Parse and extract a fetched page inside an extraction worker process,
+    returning (product_data, timings) so the parent can record the timings"""
+    timings = {}
+    return _extract_scraper.parse_page(content, url, timings), timings
+
+def get_extract_pool():
+    """Process-wide pool that runs extract_product_data in parallel with fetching.
+    
+    Returns None when SCRAPER_EXTRACT_PROCESSES is 0, in which case pages are
+    parsed on the fetch threads.
+    """
+    global _extract_pool
+    processes = app.config['SCRAPER_EXTRACT_PROCESSES']
+    if processes <= 0:
+        return None
+    
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            # Spawn rather than fork: the web process is multi-threaded
+            _extract_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_extract_worker,
+                initargs=(
+                    app.config['SCRAPER_PARSER'],
+                    app.config['SCRAPER_TRACE_SAMPLE'],
+                    app.config['SCRAPER_TRACE_HOSTS']
+                )
+            )
+            logger.info(f"Started extraction pool with {processes} processes")
+        return _extract_pool
+
+def replace_extract_pool(broken):
+    """Swap out a pool left unusable by a crashed worker, returning its replacement.
+    
+    Once a worker process dies, a ProcessPoolExecutor fails every later
+    submission with BrokenProcessPool, so the shared pool is dropped and a new
+    one started. Jobs that find the pool already replaced just get the new one.
+    """
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is broken:
+            _extract_pool = None
+            broken.shutdown(wait=False)
+            logger.warning("Extraction worker died, restarting the extraction pool")
+    return get_extract_pool()
+
+# Job progress pub/sub
+SSE_KEEPALIVE_SECONDS = 15
+# Streams end with a 'reconnect' event after this long, so one doesn't hold a
+# gunicorn worker for the whole job or outlive its default 30 s timeout
+SSE_MAX_STREAM_SECONDS = 25
+
+class JobEvents:
+    """In-process pub/sub that pushes job progress to Server-Sent Event streams.
+    
+    The scraping thread publishes (event, data) pairs; each SSE connection gets
+    its own bounded queue. A subscriber that falls too far behind has events
+    dropped rather than holding up the scraper. The latest status per job is
+    kept so new subscribers start from current progress.
+    """
+    def __init__(self, max_queue=1000):
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.subscribers = {}  # job_id -> list of queues
+        self.latest_status = {}
+    
+    def subscribe(self, job_id):
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        with self.lock:
+            self.subscribers.setdefault(job_id, []).append(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, job_id, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(job_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self.subscribers.pop(job_id, None)
+    
+    def latest(self, job_id):
+        with self.lock:
+            return self.latest_status.get(job_id)
+    
+    def publish(self, job_id, event, data):
+        with self.lock:
+            if event in ('status', 'progress'):
+                # Only a job running in this process keeps its status here
+                if data['status'] == 'running':
+                    self.latest_status[job_id] = data
+                else:
+                    self.latest_status.pop(job_id, None)
+            subscribers = list(self.subscribers.get(job_id, []))
+        
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                pass
+
+job_events = JobEvents()
+
+def format_sse(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def job_rate(job, now):
+    """URLs per second a running job has managed since its current worker claimed
+    it, so time spent queued or released doesn't count, or None"""
+    if job.status != 'running' or not job.started_at:
+        return None
+    done = (job.completed_urls or 0) - (job.started_urls or 0)
+    elapsed = (now - job.started_at).total_seconds()
+    return done / elapsed if done > 0 and elapsed > 0 else None
+
+def job_status_payload(job):
+    """Status fields shared by /api/job/<id>/status and the event stream"""
+    rate = job_rate(job, datetime.utcnow())
+    remaining = max(0, (job.total_urls or 0) - (job.completed_urls or 0))
+    return {
+        'id': job.id,
+        'status': job.status,
+        'priority': job.priority,
+        'eta_seconds': round(remaining / rate) if rate else None,
+        'total_urls': job.total_urls,
+        'completed_urls': job.completed_urls,
+        'failed_urls': job.failed_urls,
+        'unchanged_urls': job.unchanged_urls,
+        'job_type': job.job_type,
+        'current_url': job.current_url,
+        'progress': (job.completed_urls / job.total_urls * 100) if job.total_urls > 0 else 0,
+        'error_message': job.error_message
+    }
+
+# Product fields sent with each 'product' event
+PRODUCT_EVENT_FIELDS = ('title', 'price', 'part_number', 'ean', 'brand', 'color', 'image_url', 'source_url', 'availability')
+
+# Product columns filled from scraped product data
+PRODUCT_FIELDS = (
+    'title', 'price', 'description', 'part_number', 'ean', 'brand', 'color', 'condition',
+    'image_url', 'additional_images', 'source_url', 'features', 'availability', 'content_hash'
+)
+
+# Database setup and batched writes
+def init_database():
+    """Create missing tables, and missing columns and indexes on tables that already exist.
+    
+    create_all() leaves existing tables alone, so columns added to a model since
+    the database was created are added here with ALTER TABLE. They're all
+    nullable; a scalar default is applied to the rows already in the table.
+    """
+    db.create_all()
+    inspector = sqlalchemy.inspect(db.engine)
+    dialect = db.engine.dialect
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {dialect.identifier_preparer.format_table(table)} ADD COLUMN " \
+                  f"{dialect.identifier_preparer.format_column(column)} {column.type.compile(dialect=dialect)}"
+            if column.default is not None and column.default.is_scalar:
+                default = sqlalchemy.literal(column.default.arg, column.type)
+                ddl += f" DEFAULT {default.compile(dialect=dialect, compile_kwargs={'literal_binds': True})}"
+            with db.engine.begin() as connection:
+                connection.execute(sqlalchemy.text(ddl))
+            logger.info(f"Added column {table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+class BatchStore:
+    """Batched inserts and updates using the cheapest statements the database supports.
+    
+    On Postgres, inserts are sent as multi-row INSERT ... VALUES statements of up
+    to `chunk_size` rows, so a batch costs one round trip per chunk rather than
+    one per row. Other databases use SQLAlchemy's executemany bulk operations,
+    which are already cheap for in-process SQLite.
+    """
+    def __init__(self, session, chunk_size=1000):
+        self.session = session
+        self.chunk_size = chunk_size
+    
+    @property
+    def multi_row_insert(self):
+        return self.session.get_bind().dialect.name == 'postgresql'
+    
+    def insert(self, model, rows):
+        if not rows:
+            return
+        if not self.multi_row_insert:
+            self.session.bulk_insert_mappings(model, rows)
+            return
+        
+        # Every row in a multi-row VALUES needs the same columns
+        columns = sorted({column for row in rows for column in row})
+        for start in range(0, len(rows), self.chunk_size):
+            chunk = [{column: row.get(column) for column in columns} for row in rows[start:start + self.chunk_size]]
+            self.session.execute(sqlalchemy.insert(model.__table__).values(chunk))
+    
+    def update(self, model, rows):
+        if rows:
+            self.session.bulk_update_mappings(model, rows)
+
+class JobWriter:
+    """Buffers scraped products and job progress, writing them in batched commits.
+    
+    Products are bulk inserted every `batch_size` items or `flush_interval`
+    seconds, whichever comes first, and the job's progress counters are only
+    written as part of those commits rather than once per URL.
+    
+    `existing` maps source URLs to lists of ids of previously scraped products
+    (refresh jobs): changed pages update those rows in place and unchanged pages
+    only have their checked_at time bumped.
+    
+    `url_ids` maps each URL to the ids of its JobUrl rows, which are marked done
+    or failed in the same commit as the products so a resumed job carries on
+    from the last URL that was actually saved. With `add_urls` (discovery jobs,
+    which have no JobUrl rows up front) a row is added for each finished URL
+    instead.
+    
+    With `timings` (the scraper's JobTimings), commit times are recorded there
+    and the job's timing breakdown is saved with each flush.
+    """
+    def __init__(self, job, batch_size=50, flush_interval=2.0, existing=None, url_ids=None, stats=None, add_urls=False, timings=None):
+        self.job = job
+        self.stats = stats
+        self.timings = timings
+        self.store = BatchStore(db.session)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.existing = existing or {}
+        self.url_ids = url_ids or {}
+        self.rows = []
+        self.updates = []
+        self.checked_ids = []
+        self.url_updates = []
+        self.new_urls = [] if add_urls else None
+        self.completed = job.completed_urls or 0
+        self.failed = job.failed_urls or 0
+        self.unchanged = job.unchanged_urls or 0
+        self.current_url = job.current_url
+        self.last_flush = time.monotonic()
+    
+    def record(self, url, product_data, outcome=None):
+        """Record the outcome of one URL, flushing if the batch is full or due.
+        
+        `outcome` carries the attempt count and failure details from the scraper.
+        """
+        self.completed += 1
+        self.current_url = url
+        product_ids = self.existing.get(url)
+        saved = None
+        
+        if product_data and product_data.get('unchanged') and product_ids:
+            self.unchanged += 1
+            self.checked_ids.extend(product_ids)
+            metrics.inc('scraper_pages_total', outcome='unchanged')
+        elif product_data:
+            metrics.inc('scraper_pages_total', outcome='saved')
+            row = {field: product_data.get(field) for field in PRODUCT_FIELDS}
+            row['checked_at'] = datetime.utcnow()
+            if product_ids:
+                row['scraped_at'] = row['checked_at']
+                self.updates.extend(dict(row, id=product_id) for product_id in product_ids)
+            else:
+                row['job_id'] = self.job.id
+                self.rows.append(row)
+            saved = {field: row.get(field) for field in PRODUCT_EVENT_FIELDS}
+        else:
+            self.failed += 1
+            metrics.inc('scraper_pages_total', outcome='failed')
+            logger.warning(f"Failed to scrape: {url}")
+        
+        outcome = outcome or {}
+        url_status = {
+            'status': 'done' if product_data else 'failed',
+            'attempts': outcome.get('attempts', 1),
+            'failure_kind': outcome.get('failure_kind'),
+            'error': (outcome.get('error') or '')[:500] or None
+        }
+        if self.url_ids.get(url):
+            url_status['id'] = self.url_ids[url].popleft()
+            self.url_updates.append(url_status)
+        elif self.new_urls is not None:
+            url_status.update(job_id=self.job.id, position=self.completed - 1, url=url)
+            self.new_urls.append(url_status)
+        
+        # Progress goes to event stream subscribers straight away; the database
+        # only sees it at the next flush
+        self.job.current_url = self.current_url
+        self.job.completed_urls = self.completed
+        self.job.failed_urls = self.failed
+        self.job.unchanged_urls = self.unchanged
+        progress = job_status_payload(self.job)
+        if self.stats:
+            progress['pipeline'] = self.stats.snapshot()
+        job_events.publish(self.job.id, 'progress', progress)
+        if saved:
+            job_events.publish(self.job.id, 'product', saved)
+        
+        pending = len(self.rows) + len(self.updates) + len(self.checked_ids)
+        if pending >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+    
+    def flush(self):
+        """Write buffered products and job progress in a single commit"""
+        if self.rows:
+            self.store.insert(Product, self.rows)
+            logger.info(f"Saved {len(self.rows)} products for job {self.job.id}")
+        if self.updates:
+            self.store.update(Product, self.updates)
+            logger.info(f"Updated {len(self.updates)} changed products for job {self.job.id}")
+        if self.checked_ids:
+            Product.query.filter(Product.id.in_(self.checked_ids)).update(
+                {'checked_at': datetime.utcnow()}, synchronize_session=False
+            )
+        if self.url_updates:
+            self.store.update(JobUrl, self.url_updates)
+        if self.new_urls:
+            self.store.insert(JobUrl, self.new_urls)
+        if self.timings:
+            self.job.timings = json.dumps(self.timings.snapshot())
+        
+        started = time.perf_counter()
+        db.session.commit()
+        if self.timings:
+            self.timings.record('db_commit', time.perf_counter() - started)
+        if self.stats:
+            logger.info(f"Pipeline for job {self.job.id}: {self.stats.summary()}")
+        
+        self.rows = []
+        self.updates = []
+        self.checked_ids = []
+        self.url_updates = []
+        if self.new_urls:
+            self.new_urls = []
+        self.last_flush = time.monotonic()
+
+def load_existing_products(urls, job_id=None, chunk_size=500):
+    """Return {source_url: ([product ids], content_hash)} for every product row of
+    each URL, with the content hash of the latest one"""
+    existing = {}
+    urls = list(dict.fromkeys(urls))
+    for start in range(0, len(urls), chunk_size):
+        query = db.session.query(Product.id, Product.source_url, Product.content_hash).filter(
+            Product.source_url.in_(urls[start:start + chunk_size])
+        )
+        if job_id:
+            query = query.filter(Product.job_id == job_id)
+        for product_id, source_url, content_hash in query.order_by(Product.id):
+            product_ids = existing[source_url][0] if source_url in existing else []
+            product_ids.append(product_id)
+            existing[source_url] = (product_ids, content_hash)
+    return existing
+
+# Shared HTTP cache
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+def get_http_cache():
+    """Process-wide HTTP cache, or None when SCRAPER_HTTP_CACHE_DIR isn't set"""
+    global _http_cache
+    directory = app.config['SCRAPER_HTTP_CACHE_DIR']
+    if not directory:
+        return None
+    
+    with _http_cache_lock:
+        if _http_cache is None:
+            _http_cache = HttpCache(directory, app.config['SCRAPER_HTTP_CACHE_MAX_MB'] * 1024 * 1024)
+        return _http_cache
+
+# Shared result cache
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """Process-wide result cache, or None when SCRAPER_RESULT_CACHE_TTL is 0"""
+    global _result_cache
+    ttl = app.config['SCRAPER_RESULT_CACHE_TTL']
+    if ttl <= 0:
+        return None
+    
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(ttl, app.config['SCRAPER_RESULT_CACHE_SIZE'])
+        return _result_cache
+
+# Shared fetch scheduler
+_fetch_scheduler = None
+_fetch_scheduler_lock = threading.Lock()
+
+def get_fetch_scheduler():
+    """Process-wide scheduler that shares fetch slots and host limits between jobs"""
+    global _fetch_scheduler
+    with _fetch_scheduler_lock:
+        if _fetch_scheduler is None:
+            rate_limiter = HostRateLimiter(
+                delay=app.config['SCRAPER_HOST_DELAY'],
+                jitter=app.config['SCRAPER_HOST_JITTER'],
+                max_rate=app.config['SCRAPER_HOST_MAX_RATE']
+            )
+            _fetch_scheduler = FetchScheduler(app.config['SCRAPER_GLOBAL_CONCURRENCY'], rate_limiter)
+        return _fetch_scheduler
+
+# Shared HTTP client
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Process-wide HTTP client shared by every job.
+    
+    Keeping one client means connections to a host stay open between jobs, so
+    repeat scrapes skip the DNS lookup and TLS handshake.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = build_http_session(
+                pool_hosts=app.config['SCRAPER_POOL_HOSTS'],
+                pool_per_host=app.config['SCRAPER_POOL_PER_HOST'],
+                http2=app.config['SCRAPER_HTTP2']
+            )
+        return _http_session
+
+def load_host_policies(urls):
+    """Return {host: (rate, latency)} learned in earlier jobs for the hosts in `urls`"""
+    hosts = list({url_host(url) for url in urls})
+    policies = {}
+    for start in range(0, len(hosts), 500):
+        for policy in HostPolicy.query.filter(HostPolicy.host.in_(hosts[start:start + 500])):
+            policies[policy.host] = (policy.rate, policy.latency)
+    return policies
+
+def save_host_policies(rate_limiter):
+    """Store the rates a job's rate controller settled on for later jobs"""
+    now = datetime.utcnow()
+    policies = rate_limiter.policies()
+    for host, (rate, latency) in policies.items():
+        db.session.merge(HostPolicy(host=host, rate=rate, latency=latency, updated_at=now))
+    db.session.commit()
+    rate_limiter.mark_saved(policies)
+
+# Durable job queue
+class JobInterrupted(Exception):
+    """Raised when a worker stops working on a job before it has finished"""
+
+def new_worker_id():
+    """Unique name for a worker, used as the owner of its job leases"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def claimable_jobs(now):
+    """Filter for jobs a worker can claim: pending, or running on a worker whose lease ran out"""
+    return db.or_(
+        ScrapingJob.status == 'pending',
+        db.and_(ScrapingJob.status == 'running', ScrapingJob.lease_expires_at < now)
+    )
+
+def priority_rank():
+    """Sort key that puts higher priority jobs first"""
+    return db.case(
+        {name: -weight for name, weight in PRIORITY_WEIGHTS.items()},
+        value=ScrapingJob.priority,
+        else_=-PRIORITY_WEIGHTS['normal']
+    )
+
+def claim_job(worker_id, job_id=None, priorities=None):
+    """Lease the highest priority, oldest claimable job (or `job_id`) to a worker.
+    
+    With `priorities`, only jobs of those priorities are considered. The claim
+    is a conditional UPDATE, so when several workers race for the same job only
+    one of them gets it. Returns the claimed job id, or None if there is
+    nothing to claim.
+    """
+    now = datetime.utcnow()
+    query = db.session.query(ScrapingJob.id).filter(claimable_jobs(now))
+    if job_id:
+        query = query.filter(ScrapingJob.id == job_id)
+    if priorities:
+        query = query.filter(ScrapingJob.priority.in_(priorities))
+    candidates = [candidate for candidate, in query.order_by(priority_rank(), ScrapingJob.created_at).limit(5)]
+    
+    for candidate in candidates:
+        claimed = ScrapingJob.query.filter(
+            ScrapingJob.id == candidate,
+            claimable_jobs(now)
+        ).update({
+            'status': 'running',
+            'worker_id': worker_id,
+            'lease_expires_at': now + timedelta(seconds=app.config['SCRAPER_LEASE_SECONDS']),
+            'heartbeat_at': now,
+            'started_at': now,
+            'started_urls': ScrapingJob.completed_urls
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return candidate
+    return None
+
+def renew_lease(job_id, worker_id):
+    """Extend a worker's lease on a running job; False if the worker no longer holds it"""
+    now = datetime.utcnow()
+    renewed = ScrapingJob.query.filter(
+        ScrapingJob.id == job_id,
+        ScrapingJob.worker_id == worker_id,
+        ScrapingJob.status == 'running'
+    ).update({
+        'lease_expires_at': now + timedelta(seconds=app.config['SCRAPER_LEASE_SECONDS']),
+        'heartbeat_at': now
+    }, synchronize_session=False)
+    db.session.commit()
+    return bool(renewed)
+
+class LeaseHeartbeat(threading.Thread):
+    """Keeps renewing a worker's lease on a job while the job runs.
+    
+    If the lease can't be renewed because another worker has taken the job
+    over, `lost` is set and the job stops without writing anything further.
+    """
+    def __init__(self, job_id, worker_id):
+        super().__init__(daemon=True)
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = app.config['SCRAPER_LEASE_SECONDS'] / 3
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with app.app_context():
+                    if not renew_lease(self.job_id, self.worker_id):
+                        logger.warning(f"Lost lease on job {self.job_id}")
+                        self.lost.set()
+                        return
+            except Exception as e:
+                logger.error(f"Error renewing lease on job {self.job_id}: {str(e)}")
+    
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def enqueue_job(job, urls):
+    """Add a job and its URLs to the queue"""
+    db.session.add(job)
+    db.session.flush()
+    BatchStore(db.session).insert(JobUrl, [
+        {'job_id': job.id, 'position': position, 'url': url, 'status': 'pending'}
+        for position, url in enumerate(urls)
+    ])
+    db.session.commit()
+
+def run_job(job_id, worker_id, stop_event=None):
+    """Scrape the remaining URLs of a job this worker has claimed.
+    
+    Stops early if `stop_event` is set, saving progress and putting the job back
+    on the queue for any worker to resume.
+    """
+    job = ScrapingJob.query.get(job_id)
+    scraper = UniversalProductScraper(
+        delay=app.config['SCRAPER_HOST_DELAY'],
+        concurrency=app.config['SCRAPER_CONCURRENCY'],
+        jitter=app.config['SCRAPER_HOST_JITTER'],
+        extract_pool=get_extract_pool(),
+        parser=app.config['SCRAPER_PARSER'],
+        http_cache=get_http_cache(),
+        buffer_size=app.config['SCRAPER_PIPELINE_BUFFER'],
+        session=get_http_session(),
+        max_rate=app.config['SCRAPER_HOST_MAX_RATE'],
+        max_retries=app.config['SCRAPER_MAX_RETRIES'],
+        retry_base_delay=app.config['SCRAPER_RETRY_BASE_DELAY'],
+        max_page_bytes=int(app.config['SCRAPER_MAX_PAGE_MB'] * 1024 * 1024),
+        early_stop=app.config['SCRAPER_EARLY_STOP'],
+        trace_sample=app.config['SCRAPER_TRACE_SAMPLE'],
+        trace_hosts=app.config['SCRAPER_TRACE_HOSTS'],
+        # A refresh is an explicit re-check, so it mustn't reuse recent results
+        result_cache=get_result_cache() if job.job_type != 'refresh' else None,
+        scheduler=get_fetch_scheduler(),
+        weight=PRIORITY_WEIGHTS.get(job.priority, PRIORITY_WEIGHTS['normal'])
+    )
+    heartbeat = LeaseHeartbeat(job_id, worker_id)
+    heartbeat.start()
+    writer = None
+    
+    try:
+        job_events.publish(job_id, 'status', job_status_payload(job))
+        
+        # Only URLs that weren't saved before an earlier worker stopped
+        url_ids = {}
+        for url_id, url in db.session.query(JobUrl.id, JobUrl.url).filter(
+            JobUrl.job_id == job_id,
+            JobUrl.status == 'pending'
+        ).order_by(JobUrl.position):
+            url_ids.setdefault(url, deque()).append(url_id)
+        urls = [url for url, ids in url_ids.items() for _ in ids]
+        if job.completed_urls:
+            logger.info(f"Resuming job {job_id} with {len(urls)} URLs left")
+        
+        # Discovery jobs find their URLs while they scrape; a resumed one skips
+        # the URLs it has already scraped
+        discovered = None
+        if job.job_type == 'discover':
+            done = {url for url, in db.session.query(JobUrl.url).filter(JobUrl.job_id == job_id)}
+            discovered = {'count': len(done)}
+            
+            def discover():
+                for url in scraper.discover_product_urls(job.start_url, skip=done):
+                    discovered['count'] += 1
+                    yield url
+            
+            urls = discover()
+        scraper.rate_limiter.learn(load_host_policies([job.start_url] if discovered else urls))
+        
+        # Refresh jobs update the products from earlier scrapes and skip unchanged pages
+        existing = {}
+        if job.job_type == 'refresh':
+            existing = load_existing_products(urls, job_id=job.refresh_job_id)
+        
+        # Scrape products concurrently, saving them in batches as they finish
+        writer = JobWriter(
+            job,
+            batch_size=app.config['SCRAPER_DB_BATCH_SIZE'],
+            flush_interval=app.config['SCRAPER_DB_FLUSH_INTERVAL'],
+            existing={url: product_ids for url, (product_ids, _) in existing.items()},
+            url_ids=url_ids,
+            stats=scraper.stats,
+            add_urls=discovered is not None,
+            timings=scraper.timings
+        )
+        known_fingerprints = {url: content_hash for url, (_, content_hash) in existing.items() if content_hash}
+        try:
+            for url, product_data in scraper.scrape_many(urls, known_fingerprints=known_fingerprints):
+                if heartbeat.lost.is_set() or (stop_event is not None and stop_event.is_set()):
+                    raise JobInterrupted()
+                if discovered:
+                    job.total_urls = discovered['count']
+                writer.record(url, product_data, scraper.outcomes.pop(url, None))
+        except JobInterrupted:
+            raise
+        except Exception:
+            # Shutting down can break the pipeline mid-job (the executors stop
+            # taking work), which isn't the job's fault
+            if stop_event is not None and stop_event.is_set():
+                raise JobInterrupted()
+            raise
+        heartbeat.stop()
+        if heartbeat.lost.is_set():
+            raise JobInterrupted()
+        writer.flush()
+        
+        # Mark job as completed
+        if discovered:
+            job.total_urls = writer.completed
+        job.status = 'completed'
+        job.completed_at = datetime.utcnow()
+        job.completed_urls = job.total_urls
+        job.worker_id = None
+        job.lease_expires_at = None
+        db.session.commit()
+        job_events.publish(job_id, 'status', job_status_payload(job))
+        
+        logger.info(f"Scraping job {job_id} completed successfully")
+        
+    except JobInterrupted:
+        heartbeat.stop()
+        if heartbeat.lost.is_set():
+            # Another worker owns the job now; leave its progress alone
+            db.session.rollback()
+            return
+        
+        # Save what's done and hand the rest back to the queue
+        writer.flush()
+        job.status = 'pending'
+        job.worker_id = None
+        job.lease_expires_at = None
+        db.session.commit()
+        job_events.publish(job_id, 'status', job_status_payload(job))
+        logger.info(f"Released job {job_id} back to the queue")
+        
+    except Exception as e:
+        heartbeat.stop()
+        db.session.rollback()
+        job.status = 'failed'
+        job.error_message = str(e)
+        job.worker_id = None
+        job.lease_expires_at = None
+        db.session.commit()
+        job_events.publish(job_id, 'status', job_status_payload(job))
+        logger.error(f"Scraping job {job_id} failed: {str(e)}")
+
+    finally:
+        try:
+            save_host_policies(scraper.rate_limiter)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error saving host rates for job {job_id}: {str(e)}")
+
+# Job runner threads for SCRAPER_WORKER_MODE=thread
+_job_runners = []
+_job_runners_lock = threading.Lock()
+_job_queued = threading.Event()
+_job_runners_stopping = threading.Event()
+# How long interpreter exit waits for runners to hand their jobs back
+JOB_RUNNER_STOP_SECONDS = 10
+
+def run_queued_jobs(stop_event, priorities=None, wake=None):
+    """Claim and run queued jobs, in priority order, until `stop_event` is set.
+    
+    Runs on the web process's runner threads in thread mode, woken early when
+    `wake` is set, and on worker.py's threads in queue mode. With `priorities`,
+    only claims jobs of those priorities.
+    """
+    worker_id = new_worker_id()
+    with app.app_context():
+        while not stop_event.is_set():
+            try:
+                job_id = claim_job(worker_id, priorities=priorities)
+            except Exception as e:
+                logger.error(f"Error claiming job: {str(e)}")
+                db.session.rollback()
+                job_id = None
+            
+            if job_id is None:
+                if wake is not None:
+                    wake.wait(app.config['SCRAPER_WORKER_POLL_SECONDS'])
+                    wake.clear()
+                else:
+                    stop_event.wait(app.config['SCRAPER_WORKER_POLL_SECONDS'])
+                continue
+            
+            logger.info(f"Runner {worker_id} claimed job {job_id}")
+            run_job(job_id, worker_id, stop_event=stop_event)
+            db.session.remove()
+
+def job_runner_threads(stop_event, wake=None):
+    """Start this process's job runners: SCRAPER_MAX_ACTIVE_JOBS threads that take
+    any job, and SCRAPER_PRIORITY_RUNNERS that only take high priority jobs.
+    
+    Jobs in one process share its FetchScheduler, so they're fairly
+    interleaved by priority weight within SCRAPER_GLOBAL_CONCURRENCY.
+    """
+    runner_priorities = [None] * app.config['SCRAPER_MAX_ACTIVE_JOBS']
+    runner_priorities += [('high',)] * app.config['SCRAPER_PRIORITY_RUNNERS']
+    runners = []
+    for priorities in runner_priorities:
+        runner = threading.Thread(target=run_queued_jobs, args=(stop_event, priorities, wake), daemon=True)
+        runner.start()
+        runners.append(runner)
+    return runners
+
+def start_job_runners():
+    """Start the job runner threads if needed and wake them"""
+    with _job_runners_lock:
+        if not _job_runners:
+            _job_runners.extend(job_runner_threads(_job_runners_stopping, wake=_job_queued))
+            # Registered after concurrent.futures' own hook, so this runs before
+            # the executors the runners depend on are shut down
+            threading._register_atexit(stop_job_runners)
+    _job_queued.set()
+
+def stop_job_runners():
+    """Hand running jobs back to the queue when the interpreter exits (a gunicorn
+    restart or a deploy), so they resume rather than being marked failed"""
+    _job_runners_stopping.set()
+    _job_queued.set()
+    deadline = time.monotonic() + JOB_RUNNER_STOP_SECONDS
+    for runner in _job_runners:
+        runner.join(max(0, deadline - time.monotonic()))
+
+@app.before_request
+def resume_job_runners():
+    """Start the job runners on a process's first request, so jobs left queued or
+    with an expired lease by a restart resume without waiting for a new job"""
+    if not _job_runners and app.config['SCRAPER_WORKER_MODE'] != 'queue':
+        start_job_runners()
+
+# API Routes
+@app.route('/')
+def index():
+    """Serve the main page"""
+    return render_template('index.html')
+
+@app.route('/api/scrape', methods=['POST'])
+def start_scraping():
+    """Start a new scraping job"""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No URLs provided'}), 400
+        
+        job_type = data.get('job_type', 'scrape')
+        if job_type not in ('scrape', 'refresh', 'discover'):
+            return jsonify({'error': 'job_type must be scrape, refresh or discover'}), 400
+        
+        # Discovery jobs start from a store's domain and find the product URLs themselves
+        start_url = None
+        if job_type == 'discover':
+            domain = (data.get('domain') or '').strip()
+            if not domain:
+                return jsonify({'error': 'No domain provided'}), 400
+            start_url = site_root(domain)
+            data['urls'] = []
+        
+        # Refresh jobs can re-check every product from an earlier job
+        refresh_job_id = data.get('refresh_job_id') if job_type == 'refresh' else None
+        if refresh_job_id and 'urls' not in data:
+            if not ScrapingJob.query.get(refresh_job_id):
+                return jsonify({'error': 'Job to refresh not found'}), 404
+            rows = db.session.query(Product.source_url).filter_by(job_id=refresh_job_id).distinct()
+            data['urls'] = [source_url for source_url, in rows if source_url]
+        
+        if 'urls' not in data:
+            return jsonify({'error': 'No URLs provided'}), 400
+        
+        urls = [url.strip() for url in data['urls'] if url.strip()]
+        
+        if not urls and job_type != 'discover':
+            return jsonify({'error': 'No valid URLs provided'}), 400
+        
+        # Small lists are usually someone waiting on the result
+        priority = data.get('priority')
+        if priority is None:
+            interactive = job_type != 'discover' and len(urls) <= app.config['SCRAPER_INTERACTIVE_URLS']
+            priority = 'high' if interactive else 'normal'
+        if priority not in PRIORITY_WEIGHTS:
+            return jsonify({'error': f"priority must be one of {', '.join(PRIORITY_WEIGHTS)}"}), 400
+        
+        # Create new job
+        job_id = str(uuid.uuid4())
+        job = ScrapingJob(
+            id=job_id,
+            total_urls=len(urls),
+            status='pending',
+            job_type=job_type,
+            refresh_job_id=refresh_job_id,
+            start_url=start_url,
+            priority=priority
+        )
+        enqueue_job(job, urls)
+        
+        # Run it on this process's job runners, unless worker processes pick jobs up from the queue
+        if app.config['SCRAPER_WORKER_MODE'] != 'queue':
+            start_job_runners()
+        
+        return jsonify({
+            'job_id': job_id,
+            'job_type': job_type,
+            'priority': priority,
+            'status': 'started',
+            'total_urls': len(urls),
+            'start_url': start_url
+        })
+        
+    except Exception as e:
+        logger.error(f"Error starting scraping job: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def queue_status(job):
+    """Queue position of a pending job, and a rough ETA from the running jobs' throughput.
+    
+    The ETA assumes the URLs left in running jobs and in jobs ahead in the
+    queue are scraped at the rate the running jobs are managing now.
+    """
+    rank = -PRIORITY_WEIGHTS.get(job.priority, PRIORITY_WEIGHTS['normal'])
+    ahead = db.session.query(
+        db.func.count(ScrapingJob.id),
+        db.func.sum(ScrapingJob.total_urls - ScrapingJob.completed_urls)
+    ).filter(
+        ScrapingJob.status == 'pending',
+        ScrapingJob.id != job.id,
+        db.or_(
+            priority_rank() < rank,
+            db.and_(priority_rank() == rank, ScrapingJob.created_at < job.created_at)
+        )
+    ).one()
+    
+    now = datetime.utcnow()
+    rate = 0
+    remaining = (ahead[1] or 0) + max(0, job.total_urls - job.completed_urls)
+    for running in ScrapingJob.query.filter_by(status='running'):
+        rate += job_rate(running, now) or 0
+        remaining += max(0, running.total_urls - running.completed_urls)
+    
+    return {
+        'queue_position': ahead[0] + 1,
+        'eta_seconds': round(remaining / rate) if rate else None
+    }
+
+@app.route('/api/job/<job_id>/status')
+def get_job_status(job_id):
+    """Get the status of a scraping job"""
+    try:
+        job = ScrapingJob.query.get(job_id)
+        
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        payload = job_status_payload(job)
+        if job.status == 'pending':
+            payload.update(queue_status(job))
+        
+        # Stage queue depths and throughput while the job runs in this process
+        latest = job_events.latest(job_id)
+        if latest and 'pipeline' in latest:
+            payload['pipeline'] = latest['pipeline']
+        
+        return jsonify(payload)
+        
+    except Exception as e:
+        logger.error(f"Error getting job status: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/job/<job_id>/events')
+def stream_job_events(job_id):
+    """Stream job progress as Server-Sent Events.
+    
+    Sends 'status' and 'progress' events carrying the same fields as
+    /api/job/<id>/status, and a 'product' event for each newly saved product.
+    The stream ends once the job completes or fails, or with a 'reconnect'
+    event after SSE_MAX_STREAM_SECONDS, telling the client to open a new
+    stream. Events come from the in-process pub/sub; jobs run by worker
+    processes publish nothing here, so while the stream is idle the job's
+    status is re-read from the database every SCRAPER_WORKER_POLL_SECONDS
+    instead.
+    """
+    try:
+        # Subscribe before reading the job so no events are missed in between
+        subscriber = job_events.subscribe(job_id)
+        job = ScrapingJob.query.get(job_id)
+        
+        if not job:
+            job_events.unsubscribe(job_id, subscriber)
+            return jsonify({'error': 'Job not found'}), 404
+        
+        snapshot = job_status_payload(job)
+        db.session.remove()
+        poll_seconds = app.config['SCRAPER_WORKER_POLL_SECONDS']
+        
+        def generate():
+            try:
+                last = job_events.latest(job_id) or snapshot
+                yield format_sse('status', last)
+                if last['status'] in ('completed', 'failed'):
+                    return
+                
+                last_sent = started = time.monotonic()
+                while True:
+                    if time.monotonic() - started >= SSE_MAX_STREAM_SECONDS:
+                        yield format_sse('reconnect', {})
+                        return
+                    
+                    try:
+                        event, data = subscriber.get(timeout=poll_seconds)
+                    except queue.Empty:
+                        data = job_events.latest(job_id)
+                        if data is None:
+                            with app.app_context():
+                                data = job_status_payload(ScrapingJob.query.get(job_id))
+                                db.session.remove()
+                        if data != last:
+                            event = 'status' if data['status'] != last['status'] else 'progress'
+                        elif time.monotonic() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                            last_sent = time.monotonic()
+                            yield ': keepalive\n\n'
+                            continue
+                        else:
+                            continue
+                    
+                    if event in ('status', 'progress'):
+                        last = data
+                    last_sent = time.monotonic()
+                    yield format_sse(event, data)
+                    if event == 'status' and data['status'] in ('completed', 'failed'):
+                        return
+            finally:
+                job_events.unsubscribe(job_id, subscriber)
+        
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        
+    except Exception as e:
+        logger.error(f"Error streaming job events: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Product columns exposed by the products API, in response order
+PRODUCT_API_FIELDS = (
+    'id', 'title', 'price', 'description', 'part_number', 'ean', 'brand', 'color', 'condition',
+    'image_url', 'additional_images', 'source_url', 'features', 'availability'
+)
+PRODUCTS_PAGE_SIZE = 100
+PRODUCTS_MAX_PAGE_SIZE = 1000
+
+def parse_products_query(args):
+    """Read after_id, limit and fields from the query string.
+    
+    Returns (after_id, limit, fields) or raises ValueError with a message for the client.
+    """
+    try:
+        after_id = int(args.get('after_id', 0))
+        limit = int(args.get('limit', PRODUCTS_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('after_id and limit must be integers')
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    
+    fields = PRODUCT_API_FIELDS
+    if args.get('fields'):
+        fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in PRODUCT_API_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        # The id is always returned since it's the pagination cursor
+        fields = ['id'] + [field for field in fields if field != 'id']
+    
+    return after_id, limit, fields
+
+def query_products(job_id, after_id, fields):
+    """Keyset-paginated query for the selected product columns, in id order"""
+    columns = [getattr(Product, field) for field in fields]
+    return db.session.query(*columns).filter(
+        Product.job_id == job_id,
+        Product.id > after_id
+    ).order_by(Product.id)
+
+@app.route('/api/job/<job_id>/products')
+def get_job_products(job_id):
+    """Get a page of products from a scraping job.
+    
+    Use ?after_id=<id from next_after_id>&limit=<n> to page through the job and
+    ?fields=title,price,... to return only some columns.
+    """
+    try:
+        job = ScrapingJob.query.get(job_id)
+        
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        try:
+            after_id, limit, fields = parse_products_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        limit = min(limit, PRODUCTS_MAX_PAGE_SIZE)
+        
+        rows = query_products(job_id, after_id, fields).limit(limit).all()
+        product_data = [dict(zip(fields, row)) for row in rows]
+        
+        return jsonify({
+            'products': product_data,
+            'next_after_id': product_data[-1]['id'] if len(product_data) == limit else None
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting job products: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/job/<job_id>/products.ndjson')
+def stream_job_products(job_id):
+    """Stream a job's products as newline-delimited JSON, one product per line"""
+    try:
+        job = ScrapingJob.query.get(job_id)
+        
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        try:
+            after_id, limit, fields = parse_products_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        query = query_products(job_id, after_id, fields)
+        if 'limit' in request.args:
+            query = query.limit(limit)
+        
+        def generate():
+            for row in query.yield_per(500):
+                yield json.dumps(dict(zip(fields, row))) + '\n'
+        
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+    except Exception as e:
+        logger.error(f"Error streaming job products: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/job/<job_id>/urls')
+def get_job_urls(job_id):
+    """Get a page of a job's URLs with their status, attempts and failure reason.
+    
+    Filter with ?status=pending|done|failed and ?failure_kind=transient|permanent|blocked,
+    and page through with ?after_id=<id from next_after_id>&limit=<n>.
+    """
+    try:
+        job = ScrapingJob.query.get(job_id)
+        
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        try:
+            after_id = int(request.args.get('after_id', 0))
+            limit = int(request.args.get('limit', PRODUCTS_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'after_id and limit must be integers'}), 400
+        if limit < 1:
+            return jsonify({'error': 'limit must be at least 1'}), 400
+        limit = min(limit, PRODUCTS_MAX_PAGE_SIZE)
+        
+        query = JobUrl.query.filter(JobUrl.job_id == job_id, JobUrl.id > after_id)
+        if request.args.get('status'):
+            query = query.filter(JobUrl.status == request.args['status'])
+        if request.args.get('failure_kind'):
+            query = query.filter(JobUrl.failure_kind == request.args['failure_kind'])
+        
+        job_urls = query.order_by(JobUrl.id).limit(limit).all()
+        url_data = [{
+            'id': job_url.id,
+            'url': job_url.url,
+            'status': job_url.status,
+            'attempts': job_url.attempts,
+            'failure_kind': job_url.failure_kind,
+            'error': job_url.error
+        } for job_url in job_urls]
+        
+        return jsonify({
+            'urls': url_data,
+            'next_after_id': url_data[-1]['id'] if len(url_data) == limit else None
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting job URLs: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Shopify CSV headers
+SHOPIFY_CSV_FIELDS = [
+    'Handle', 'Title', 'Body (HTML)', 'Vendor', 'Product Category', 'Type',
+    'Tags', 'Published', 'Option1 Name', 'Option1 Value', 'Option2 Name', 'Option2 Value',
+    'Option3 Name', 'Option3 Value', 'Variant SKU', 'Variant Grams', 'Variant Inventory Tracker',
+    'Variant Inventory Qty', 'Variant Inventory Policy', 'Variant Fulfillment Service',
+    'Variant Price', 'Variant Compare At Price', 'Variant Requires Shipping', 'Variant Taxable',
+    'Variant Barcode', 'Image Src', 'Image Position', 'Image Alt Text', 'Gift Card',
+    'SEO Title', 'SEO Description', 'Cost per item', 'Status'
+]
+
+def generate_shopify_csv(job_id, chunk_size=500):
+    """Yield a job's products as Shopify CSV text, a chunk of rows at a time"""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=SHOPIFY_CSV_FIELDS)
+    writer.writeheader()
+    
+    products = Product.query.filter_by(job_id=job_id).order_by(Product.id).yield_per(chunk_size)
+    for i, product in enumerate(products, 1):
+        # Generate handle from title
+        handle = ''
+        if product.title:
+            handle = re.sub(r'[^a-zA-Z0-9\s-]', '', product.title.lower())
+            handle = re.sub(r'\s+', '-', handle).strip('-')
+        
+        # Clean price
+        price = ''
+        if product.price:
+            price_match = re.search(r'([\d,]+\.?\d*)', product.price)
+            if price_match:
+                price = price_match.group(1).replace(',', '')
+        
+        row = {
+            'Handle': handle,
+            'Title': product.title or '',
+            'Body (HTML)': product.description or '',
+            'Vendor': product.brand or '',
+            'Published': 'TRUE',
+            'Variant SKU': product.part_number or '',
+            'Variant Inventory Tracker': 'shopify',
+            'Variant Inventory Qty': '10',  # Default quantity
+            'Variant Inventory Policy': 'deny',
+            'Variant Fulfillment Service': 'manual',
+            'Variant Price': price,
+            'Variant Requires Shipping': 'TRUE',
+            'Variant Taxable': 'TRUE',
+            'Variant Barcode': product.ean or '',
+            'Image Src': product.image_url or '',
+            'Image Position': '1',
+            'Image Alt Text': product.title or '',
+            'Gift Card': 'FALSE',
+            'SEO Title': product.title or '',
+            'SEO Description': product.description[:160] if product.description else '',
+            'Status': 'active'
+        }
+        
+        writer.writerow(row)
+        
+        if i % chunk_size == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    
+    yield output.getvalue()
+
+@app.route('/api/job/<job_id>/export/shopify')
+def export_shopify_csv(job_id):
+    """Export products as Shopify CSV"""
+    try:
+        job = ScrapingJob.query.get(job_id)
+        
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        if not db.session.query(Product.id).filter_by(job_id=job_id).first():
+            return jsonify({'error': 'No products found'}), 404
+        
+        filename = f'shopify_products_{job_id[:8]}_{datetime.now().strftime("%Y%m%d")}.csv'
+        
+        # Stream the CSV: products are read in chunks and each chunk of rows is sent
+        # as soon as it's written, so memory stays flat however large the job is
+        return Response(
+            stream_with_context(generate_shopify_csv(job_id)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
+        
+    except Exception as e:
+        logger.error(f"Error exporting CSV: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/jobs')
+def list_jobs():
+    """List all scraping jobs"""
+    try:
+        jobs = ScrapingJob.query.order_by(ScrapingJob.created_at.desc()).limit(20).all()
+        
+        job_data = []
+        for job in jobs:
+            job_data.append({
+                'id': job.id,
+                'status': job.status,
+                'total_urls': job.total_urls,
+                'completed_urls': job.completed_urls,
+                'failed_urls': job.failed_urls,
+                'unchanged_urls': job.unchanged_urls,
+                'job_type': job.job_type,
+                'priority': job.priority,
+                'created_at': job.created_at.isoformat(),
+                'completed_at': job.completed_at.isoformat() if job.completed_at else None
+            })
+        
+        return jsonify({'jobs': job_data})
+        
+    except Exception as e:
+        logger.error(f"Error listing jobs: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/job/<job_id>/timings')
+def get_job_timings(job_id):
+    """Per-stage timing breakdown for a job, as of its last saved batch"""
+    try:
+        job = ScrapingJob.query.get(job_id)
+        
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'stages': json.loads(job.timings) if job.timings else {}
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting job timings: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Scraper counters and timing histograms in the Prometheus text format.
+    
+    Only covers jobs run by this process; with SCRAPER_WORKER_MODE=queue the
+    per-job breakdown from /api/job/<id>/timings still includes worker jobs.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Health check endpoint
+@app.route('/health')
+def health_check():
+    """Health check endpoint"""
+    return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
+
+if __name__ == '__main__':
+    # Get port from environment variable for deployment
+    port = int(os.environ.get('PORT', 5000))
+    
+    # Create database tables
+    with app.app_context():
+        init_database()
+        logger.info("Database tables created successfully")
+    
+    # Pick up jobs a previous run left queued or running
+    if app.config['SCRAPER_WORKER_MODE'] != 'queue':
+        start_job_runners()
+    
+    # Run the app
+    logger.info(f"Starting app on port {port}")
+    app.run(debug=False, host='0.0.0.0', port=port)
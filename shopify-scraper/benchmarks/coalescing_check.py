@@ -0,0 +1,117 @@
+# coalescing_check.py - Check that jobs sharing a URL finish whatever the leading fetch does
+#
+# Runs two overlapping jobs against local fixture servers. Job A fetches URL X on
+# a slow host; job B starts while that fetch is in flight, with a URL on a fast
+# host followed by X, so B waits on A's fetch of X instead of making its own.
+# Checked for each outcome of A's fetch:
+#
+#   - success: B gets A's result and X is only requested once
+#   - 404: B fetches X itself once A gives up, and both jobs still finish
+#
+#   python benchmarks/coalescing_check.py [--latency MS] [--timeout S]
+#
+# Exits non-zero if a job doesn't finish in time or the request counts are off.
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Always a throwaway database, whatever DATABASE_URL points at; set before the app is imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='scraper-coalesce-'), 'check.db')
+
+from pipeline_bench import FIXTURES_DIR, FixtureServer, load_fixtures  # noqa: E402
+
+from app import ScrapingJob, app, claim_job, db, enqueue_job, init_database, logger, new_worker_id, run_job  # noqa: E402
+
+def start_job(name, urls):
+    """Queue a job and run it on its own thread, returning (job id, thread)"""
+    with app.app_context():
+        job = ScrapingJob(id=f"coalesce-{name}-{int(time.time() * 1000)}", total_urls=len(urls), status='pending')
+        enqueue_job(job, urls)
+        job_id = job.id
+
+    def work():
+        with app.app_context():
+            worker_id = new_worker_id()
+            if claim_job(worker_id, job_id):
+                run_job(job_id, worker_id)
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+    return job_id, thread
+
+def run_case(label, slow, fast, page, expected_requests, timeout):
+    """Run the overlapping jobs for one outcome of X, returning a list of problems"""
+    shared_url = f"{slow.base_url}/products/{page}"
+    requests_before = slow.requests
+
+    job_a, thread_a = start_job('a', [shared_url])
+    # Let A's request for X get under way before B asks for it
+    time.sleep(slow.latency / 1000.0 / 2)
+    job_b, thread_b = start_job('b', [f"{fast.base_url}/products/{page}-fast", shared_url])
+
+    problems = []
+    deadline = time.monotonic() + timeout
+    for name, job_id, thread in (('A', job_a, thread_a), ('B', job_b, thread_b)):
+        thread.join(max(0, deadline - time.monotonic()))
+        with app.app_context():
+            job = db.session.get(ScrapingJob, job_id)
+            status = f"{job.status} {job.completed_urls}/{job.total_urls}"
+        if thread.is_alive():
+            problems.append(f"    job {name} didn't finish within {timeout:.0f} s ({status})")
+        print(f"  {label}: job {name} {status}")
+
+    requests = slow.requests - requests_before
+    print(f"  {label}: {requests} request(s) for X")
+    if requests != expected_requests:
+        problems.append(f"    {label}: expected {expected_requests} request(s) for X, got {requests}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Check request coalescing between overlapping jobs')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--latency', type=float, default=1000, help='latency of the slow host in ms')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for each case')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        print(f"No fixture pages found in {args.fixtures}")
+        return 1
+
+    app.config.update(
+        SCRAPER_HOST_DELAY=0,
+        SCRAPER_HOST_JITTER=0,
+        SCRAPER_MAX_RETRIES=0,
+        SCRAPER_HTTP_CACHE_DIR='',
+        SCRAPER_RESULT_CACHE_TTL=300
+    )
+    with app.app_context():
+        init_database()
+
+    slow = FixtureServer(pages, args.latency, 0, 0.0, 1)
+    fast = FixtureServer(pages, 10, 0, 0.0, 2)
+    for server in (slow, fast):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    name = next(iter(pages))
+    problems = []
+    problems += run_case('success', slow, fast, f"{name}-shared", 1, args.timeout)
+    # Fixture names that don't exist are answered with 404
+    problems += run_case('404', slow, fast, 'missing-shared', 2, args.timeout)
+
+    if problems:
+        print('\n'.join(problems))
+        return 1
+    print("Coalesced jobs finished for every outcome of the leading fetch")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# parser_parity.py - Compare extraction results and speed across HTML parser backends
+#
+# Parses every page in the fixture corpus with each parser backend and runs the
+# soup heuristics (UniversalProductScraper.extract_product_data) on the result,
+# even for pages whose structured data would normally skip them. Reports any
+# field that differs from the html.parser baseline, and the average raw parse
+# and extraction time for each page.
+#
+#   python benchmarks/parser_parity.py [--fixtures DIR] [--repeat N]
+#
+# Exits non-zero if any backend produces different extraction results.
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from app import PARSER_BACKENDS, UniversalProductScraper, logger  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixtures(fixtures_dir):
+    """Load every .html page in the fixture directory as (name, url, bytes)"""
+    pages = []
+    for name in sorted(os.listdir(fixtures_dir)):
+        if not name.endswith('.html'):
+            continue
+        with open(os.path.join(fixtures_dir, name), 'rb') as f:
+            content = f.read()
+        url = f"https://fixtures.local/products/{name[:-len('.html')].replace('_', '-')}"
+        pages.append((name, url, content))
+    return pages
+
+def run_backend(parser, pages, repeat):
+    """Parse and extract every page with one backend.
+    
+    Returns (results, timings), where timings maps each page name to its
+    average (parse seconds, extraction seconds), or (None, None) if the
+    backend isn't installed.
+    """
+    scraper = UniversalProductScraper(parser=parser)
+    if scraper.parser != parser:
+        return None, None
+
+    results = {}
+    timings = {name: [0.0, 0.0] for name, _, _ in pages}
+    for _ in range(repeat):
+        for name, url, content in pages:
+            started = time.perf_counter()
+            soup = BeautifulSoup(content, parser, from_encoding='utf-8')
+            parsed = time.perf_counter()
+            results[name] = scraper.extract_product_data(soup, url)
+            timings[name][0] += parsed - started
+            timings[name][1] += time.perf_counter() - parsed
+    return results, {name: (parse / repeat, extract / repeat) for name, (parse, extract) in timings.items()}
+
+def print_timings(backend, timings, baseline=None):
+    """Print per-page parse and extraction times, with speedups over html.parser"""
+    average = tuple(sum(times[i] for times in timings.values()) / len(timings) for i in (0, 1))
+    rows = list(timings.items()) + [('average', average)]
+    print(f"  {backend}:")
+    for name, (parse, extract) in rows:
+        line = f"    {name:<32} parse {parse * 1000:7.1f} ms  extract {extract * 1000:6.1f} ms"
+        if baseline:
+            base_parse, base_extract = baseline[name]
+            line += f"  ({base_parse / parse:.1f}x parse, {base_extract / extract:.1f}x extract)"
+        print(line)
+    return dict(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare extraction results and speed across HTML parser backends')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # Extraction debug logging would dominate the timings
+    logger.setLevel(logging.WARNING)
+
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        print(f"No fixture pages found in {args.fixtures}")
+        return 1
+
+    baseline, timings = run_backend('html.parser', pages, args.repeat)
+    print(f"{len(pages)} pages, {args.repeat} runs each")
+    baseline_timings = print_timings('html.parser', timings)
+
+    mismatches = 0
+    for backend in PARSER_BACKENDS:
+        if backend == 'html.parser':
+            continue
+
+        results, timings = run_backend(backend, pages, args.repeat)
+        if results is None:
+            print(f"  {backend}: not installed, skipped")
+            continue
+        print_timings(backend, timings, baseline_timings)
+
+        for name, expected in baseline.items():
+            actual = results[name]
+            for field in sorted(set(expected) | set(actual)):
+                if expected.get(field) != actual.get(field):
+                    mismatches += 1
+                    print(f"    MISMATCH {name} [{field}]")
+                    print(f"      html.parser: {expected.get(field)!r}")
+                    print(f"      {backend}: {actual.get(field)!r}")
+
+    if mismatches:
+        print(f"{mismatches} field(s) differ from html.parser")
+        return 1
+    print("All backends produce identical extraction results")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+# pipeline_bench.py - Run full scraping jobs against a local fixture server
+#
+# Serves the fixture corpus from local HTTP servers (one per simulated host) with
+# configurable latency and injected errors, runs a complete job through the
+# queue, pipeline and database writer, and reports:
+#
+#   - pages/sec for the whole job and p50/p99 latency per page (first request
+#     for the page to its result reaching the writer)
+#   - CPU time per extraction stage (structured data, HTML parse, heuristics)
+#   - peak RSS of this process and of any extraction worker processes
+#   - accuracy of every saved product against fixtures/expected.json
+#
+#   python benchmarks/pipeline_bench.py [--pages N] [--hosts N] [--latency MS]
+#       [--latency-jitter MS] [--error-rate P] [--processes N] [--parser NAME]
+#       [--update-expected]
+#
+# Exits non-zero if any saved product differs from the expected output.
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import resource
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The job database is a throwaway SQLite file, set before the app reads its config
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='scraper-bench-'), 'bench.db'))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from app import (  # noqa: E402
+    Product, ScrapingJob, UniversalProductScraper, app, claim_job, db, enqueue_job,
+    extract_structured_data, get_extract_pool, job_events, logger, new_worker_id, run_job
+)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+EXPECTED_FILE = os.path.join(FIXTURES_DIR, 'expected.json')
+
+# Extracted fields checked against the expected output
+CHECKED_FIELDS = (
+    'title', 'price', 'description', 'part_number', 'ean', 'brand', 'color', 'condition',
+    'image_url', 'additional_images', 'features', 'availability'
+)
+
+def load_fixtures(fixtures_dir):
+    """Load every .html page in the fixture directory as {name: bytes}"""
+    pages = {}
+    for name in sorted(os.listdir(fixtures_dir)):
+        if name.endswith('.html'):
+            with open(os.path.join(fixtures_dir, name), 'rb') as f:
+                pages[name[:-len('.html')]] = f.read()
+    return pages
+
+class FixtureServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serves /products/<fixture>-<n> with injected latency and errors"""
+    daemon_threads = True
+
+    def __init__(self, pages, latency, latency_jitter, error_rate, seed):
+        super().__init__(('127.0.0.1', 0), FixtureHandler)
+        self.pages = pages
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.first_request = {}  # path -> monotonic time of the first request
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.first_request.setdefault(self.path, time.monotonic())
+            delay = max(0, server.latency + server.random.uniform(-server.latency_jitter, server.latency_jitter))
+            failing = server.random.random() < server.error_rate
+            if failing:
+                server.errors += 1
+        time.sleep(delay / 1000.0)
+
+        name = self.path.rsplit('/', 1)[-1].rsplit('-', 1)[0]
+        body = server.pages.get(name) if self.path.startswith('/products/') else None
+        if failing:
+            self.respond(503, b'Service Unavailable', 'text/plain')
+        elif body is None:
+            self.respond(404, b'Not Found', 'text/plain')
+        else:
+            self.respond(200, body, 'text/html; charset=utf-8')
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def profile_stages(pages, parser, repeat):
+    """CPU seconds per page for each extraction stage, averaged over the corpus"""
+    scraper = UniversalProductScraper(parser=scraper_parser(parser))
+    totals = {'structured data': 0.0, 'html parse': 0.0, 'heuristics': 0.0}
+    for _ in range(repeat):
+        for name, content in pages.items():
+            url = f"https://fixtures.local/products/{name}"
+            html_text = content.decode('utf-8', errors='replace')
+
+            started = time.process_time()
+            extract_structured_data(html_text)
+            parsed = time.process_time()
+            soup = BeautifulSoup(content, scraper.parser, from_encoding='utf-8')
+            built = time.process_time()
+            scraper.extract_product_data(soup, url)
+            done = time.process_time()
+
+            totals['structured data'] += parsed - started
+            totals['html parse'] += built - parsed
+            totals['heuristics'] += done - built
+    runs = repeat * len(pages)
+    return {stage: seconds / runs for stage, seconds in totals.items()}
+
+def scraper_parser(parser):
+    return parser or app.config['SCRAPER_PARSER']
+
+def run_benchmark_job(urls):
+    """Queue a job for `urls`, run it to completion, and return (job, page latencies by URL, seconds)"""
+    with app.app_context():
+        job = ScrapingJob(id=f"bench-{int(time.time() * 1000)}", total_urls=len(urls), status='pending')
+        enqueue_job(job, urls)
+        job_id = job.id
+
+    done_at = {}
+    subscriber = job_events.subscribe(job_id)
+
+    def work():
+        with app.app_context():
+            worker_id = new_worker_id()
+            if claim_job(worker_id, job_id):
+                run_job(job_id, worker_id)
+
+    started = time.monotonic()
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+
+    # Each 'progress' event marks one URL's result reaching the writer
+    while True:
+        event, data = subscriber.get()
+        if event == 'progress':
+            done_at.setdefault(data['current_url'], time.monotonic())
+        elif event == 'status' and data['status'] in ('completed', 'failed'):
+            break
+    worker.join()
+    elapsed = time.monotonic() - started
+    job_events.unsubscribe(job_id, subscriber)
+
+    with app.app_context():
+        job = db.session.get(ScrapingJob, job_id)
+        db.session.expunge(job)
+    return job, done_at, elapsed
+
+def saved_products(job_id):
+    """{fixture name: [product dicts]} for every product the job saved"""
+    products = {}
+    with app.app_context():
+        for product in Product.query.filter_by(job_id=job_id):
+            name = product.source_url.rsplit('/', 1)[-1].rsplit('-', 1)[0]
+            products.setdefault(name, []).append({field: getattr(product, field) for field in CHECKED_FIELDS})
+    return products
+
+def check_accuracy(products, expected):
+    """Compare saved products with the expected output, returning a list of mismatch lines"""
+    mismatches = []
+    for name, found in sorted(products.items()):
+        if name not in expected:
+            mismatches.append(f"    NO EXPECTED OUTPUT {name} (run with --update-expected)")
+            continue
+        # Every copy of a page should extract the same; report each field once
+        for field in CHECKED_FIELDS:
+            wrong = [product.get(field) for product in found if product.get(field) != expected[name].get(field)]
+            if wrong:
+                mismatches.append(
+                    f"    MISMATCH {name} [{field}] in {len(wrong)} of {len(found)} copies\n"
+                    f"      expected: {expected[name].get(field)!r}\n"
+                    f"      actual:   {wrong[0]!r}"
+                )
+    return mismatches
+
+def max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark full scraping jobs against a local fixture server')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--pages', type=int, default=200, help='pages to scrape per job')
+    parser.add_argument('--hosts', type=int, default=4, help='fixture servers, each seen as a separate host')
+    parser.add_argument('--latency', type=float, default=50, help='mean response latency in ms')
+    parser.add_argument('--latency-jitter', type=float, default=25, help='latency varies by up to this many ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--concurrency', type=int, default=app.config['SCRAPER_CONCURRENCY'])
+    parser.add_argument('--processes', type=int, default=0, help='extraction worker processes')
+    parser.add_argument('--parser', default=None, help='HTML parser backend (default SCRAPER_PARSER)')
+    parser.add_argument('--profile-repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--update-expected', action='store_true', help='write the extraction results as the expected output')
+    args = parser.parse_args()
+
+    # Extraction debug logging would dominate the timings
+    logger.setLevel(logging.WARNING)
+
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        print(f"No fixture pages found in {args.fixtures}")
+        return 1
+
+    app.config.update(
+        SCRAPER_CONCURRENCY=args.concurrency,
+        SCRAPER_GLOBAL_CONCURRENCY=args.concurrency,
+        SCRAPER_EXTRACT_PROCESSES=args.processes,
+        SCRAPER_PARSER=scraper_parser(args.parser),
+        SCRAPER_HOST_DELAY=0,
+        SCRAPER_HOST_JITTER=0,
+        SCRAPER_RETRY_BASE_DELAY=0.05,
+        SCRAPER_HTTP_CACHE_DIR=''
+    )
+    with app.app_context():
+        db.create_all()
+
+    servers = []
+    for i in range(max(1, args.hosts)):
+        server = FixtureServer(pages, args.latency, args.latency_jitter, args.error_rate, args.seed + i)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    names = list(pages)
+    urls = [
+        f"{servers[i % len(servers)].base_url}/products/{names[i % len(names)]}-{i}"
+        for i in range(args.pages)
+    ]
+
+    job, done_at, elapsed = run_benchmark_job(urls)
+
+    first_request = {}
+    for server in servers:
+        first_request.update({server.base_url + path: at for path, at in server.first_request.items()})
+    latencies = [done_at[url] - first_request[url] for url in done_at if url in first_request]
+    requests_made = sum(server.requests for server in servers)
+    errors_injected = sum(server.errors for server in servers)
+
+    print(f"{len(urls)} pages from {len(pages)} fixtures on {len(servers)} hosts, "
+          f"{args.latency:.0f}±{args.latency_jitter:.0f} ms latency, {args.error_rate:.0%} errors")
+    print(f"  job {job.status}: {job.completed_urls - job.failed_urls} saved, {job.failed_urls} failed, "
+          f"{requests_made} requests ({errors_injected} errors injected)")
+    print(f"  throughput: {len(urls) / elapsed:.1f} pages/sec ({elapsed:.2f} s)")
+    print(f"  page latency: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms")
+
+    stages = profile_stages(pages, args.parser, args.profile_repeat)
+    print("  CPU per page by extraction stage:")
+    for stage, seconds in stages.items():
+        print(f"    {stage}: {seconds * 1000:.2f} ms")
+
+    # Worker processes only count towards RUSAGE_CHILDREN once they've exited
+    pool = get_extract_pool()
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+    print(f"  peak RSS: {max_rss_mb(resource.RUSAGE_SELF):.0f} MB", end='')
+    if args.processes:
+        print(f" (extraction workers {max_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB)")
+    else:
+        print()
+
+    products = saved_products(job.id)
+    if args.update_expected:
+        expected = {name: found[0] for name, found in sorted(products.items())}
+        with open(EXPECTED_FILE, 'w', encoding='utf-8') as f:
+            json.dump(expected, f, indent=2, ensure_ascii=False, sort_keys=True)
+            f.write('\n')
+        print(f"Wrote expected output for {len(expected)} fixtures to {EXPECTED_FILE}")
+        return 0
+
+    if not os.path.exists(EXPECTED_FILE):
+        print(f"No expected output at {EXPECTED_FILE}; run with --update-expected")
+        return 1
+    with open(EXPECTED_FILE, encoding='utf-8') as f:
+        expected = json.load(f)
+
+    mismatches = check_accuracy(products, expected)
+    if mismatches:
+        print('\n'.join(mismatches))
+        print(f"{len(mismatches)} field(s) differ from the expected output")
+        return 1
+    print("All saved products match the expected output")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
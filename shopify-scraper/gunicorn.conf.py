@@ -0,0 +1,21 @@
+# gunicorn.conf.py - gunicorn settings for the web app, picked up from the working directory
+#
+#   gunicorn app:app
+#
+# Each open /api/job/<id>/events stream holds a worker thread until it ends (at
+# most SSE_MAX_STREAM_SECONDS), so threaded workers keep a few progress streams
+# from starving ordinary requests the way sync workers would.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+def on_starting(server):
+    """Create the database and add any new columns once, before workers start"""
+    from app import app, db, init_database
+    with app.app_context():
+        init_database()
+        # Workers are forked from here, so don't hand them these connections
+        db.engine.dispose()
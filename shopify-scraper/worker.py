@@ -0,0 +1,72 @@
+# worker.py - Scraping worker processes for the durable job queue
+#
+# Claims pending jobs from the database (and jobs whose worker stopped renewing
+# its lease) and scrapes them, resuming from the URLs that haven't been saved
+# yet. Run the web app with SCRAPER_WORKER_MODE=queue so it only enqueues jobs:
+#
+#   python worker.py [--processes N] [--jobs N]
+#
+# Each process runs up to --jobs jobs at once (SCRAPER_MAX_ACTIVE_JOBS by
+# default), plus SCRAPER_PRIORITY_RUNNERS high priority ones. Jobs in one process
+# share its fetch slots and are interleaved by priority; separate processes
+# each have their own SCRAPER_GLOBAL_CONCURRENCY slots and don't share them.
+#
+# SIGTERM or Ctrl-C stops each worker after saving its progress and puts any
+# unfinished jobs back on the queue.
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+from app import app, init_database, job_runner_threads, logger
+
+def work(stop_event):
+    """Run job runner threads until the stop event is set and they've saved their jobs"""
+    logger.info(f"Worker process {os.getpid()} started")
+    for runner in job_runner_threads(stop_event):
+        runner.join()
+    logger.info(f"Worker process {os.getpid()} stopped")
+
+def run_worker(jobs=None):
+    """Entry point for one worker process"""
+    if jobs:
+        app.config['SCRAPER_MAX_ACTIVE_JOBS'] = jobs
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    work(stop_event)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run scraping workers for the job queue')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--jobs', type=int, help='jobs each process runs at once (default SCRAPER_MAX_ACTIVE_JOBS)')
+    args = parser.parse_args()
+
+    with app.app_context():
+        init_database()
+
+    if args.processes <= 1:
+        run_worker(args.jobs)
+        return 0
+
+    # Spawn rather than fork so each worker opens its own database connections
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(args.jobs,)) for _ in range(args.processes)]
+    for process in workers:
+        process.start()
+
+    def stop(*_):
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in workers:
+        process.join()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())